@@ -0,0 +1,63 @@
+"""
+Micro-benchmark: HTML-to-text backends used by EmailParser.remove_html (parse_thread).
+
+Each installed backend converts synthetic marketing-style HTML (nested tables, inline styles, a <style> block, a
+tracking <script> and a quoted <blockquote> history) of growing size. The cleaned text of every backend is checked
+against the BeautifulSoup fallback so a faster backend cannot silently change what reaches the routers.
+
+    python benchmarks/bench_html_to_text.py
+"""
+import importlib.util
+import pathlib
+import timeit
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def marketing_html(rows):
+    style = "<style>" + "".join(f".c{index} {{ color: #{index:06x}; padding: 4px; }}\n" for index in range(200)) + "</style>"
+    script = "<script>window.dataLayer = window.dataLayer || []; function track(id) { dataLayer.push(id); }</script>"
+    table_rows = "".join(
+        f'<tr><td class="c{index % 200}" style="font-family: Arial; font-size: 14px;">'
+        f'<table><tr><td><a href="https://example.com/listing/{index}?utm_source=mail">Listing {index}</a></td>'
+        f"<td>&nbsp;Suite {index} &mdash; {index * 100} sq ft available now</td></tr></table></td></tr>\n"
+        for index in range(rows)
+    )
+    quoted = "<blockquote>" + "".join(f"<p>Earlier message line {index}</p>" for index in range(rows // 4)) + "</blockquote>"
+    return (
+        f"<html><head><title>Portfolio update</title>{style}</head><body>"
+        f"<p>Hi there,</p><p>Here are this week's available suites.</p><table>{table_rows}</table>"
+        f"{script}<p>Thanks,</p>{quoted}</body></html>"
+    )
+
+
+def main():
+    parse_thread = load_step("1_parse_thread", "parse_thread")
+    cleaner = parse_thread.ReplyCleaner()
+    fallback = parse_thread.BeautifulSoupHtmlToText()
+    backends = [backend() for backend in parse_thread.HTML_TO_TEXT_BACKENDS if backend.available()]
+
+    print(f"{'rows':>6} {'size KB':>9} " + " ".join(f"{backend.name + ' ms':>18}" for backend in backends))
+    for rows in (100, 500, 1000, 2500):
+        content = marketing_html(rows)
+        expected = cleaner.clean(fallback.to_text(content))
+        runs = max(1, 2000 // rows)
+        timings = []
+        for backend in backends:
+            if cleaner.clean(backend.to_text(content)) != expected:
+                raise SystemExit(f"{backend.name} text differs from beautifulsoup at {rows} rows")
+            timings.append(timeit.timeit(lambda: backend.to_text(content), number=runs) / runs * 1000)
+        print(f"{rows:>6} {len(content) / 1024:>9.1f} " + " ".join(f"{timing:>18.2f}" for timing in timings))
+
+    print(f"\nauto backend: {parse_thread.create_html_to_text().name}")
+
+
+if __name__ == "__main__":
+    main()
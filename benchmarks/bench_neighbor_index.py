@@ -0,0 +1,95 @@
+"""
+Benchmark: nearest-neighbor router index (semantic_routers NearestNeighborIndex).
+
+Synthetic inbound mail from a handful of templates (vendor notifications, "send me pricing" requests, meeting
+replies), each filled with different names, numbers and companies. Every email is looked up against the ones
+indexed before it, then inserted with its template's answer. Reports lookup time, how often the nearest email was
+similar enough to reuse, and how often the reused answer was the right one.
+
+    python benchmarks/bench_neighbor_index.py
+"""
+import contextlib
+import importlib.util
+import io
+import os
+import pathlib
+import random
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+TEMPLATES = [
+    ("notification", "Your invoice #{number} from {company} is ready. View it in your dashboard. Amount due: ${amount}. "
+                     "This is an automated message, please do not reply to this email."),
+    ("notification", "{company} weekly digest: {number} new listings match your saved search in {city}. "
+                     "Manage your alerts or unsubscribe at any time from your account settings."),
+    ("pricing", "Hi, I'm {name} from {company}. We manage about {number} buildings in {city} and would like to see "
+                "pricing for the lease abstraction product. Could you send me a quote?"),
+    ("pricing", "Hello, could you send over pricing for {number} seats? {name} at {company} mentioned your tool for "
+                "lease reviews and we are comparing options this quarter."),
+    ("meeting", "Thanks {name}, {day} at {hour}pm works for us. I'll bring our head of operations from {company}. "
+                "Can you share the deck beforehand?"),
+]
+NAMES = ["Jordan", "Priya", "Alex", "Morgan", "Sam", "Taylor", "Chen", "Lena"]
+COMPANIES = ["Northwind Realty", "Harbor Properties", "Summit Estates", "Oakline Group", "Bluebird Holdings"]
+CITIES = ["Denver", "Austin", "Boston", "Seattle", "Chicago"]
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday"]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_email(generator):
+    label, template = generator.choice(TEMPLATES)
+    body = template.format(
+        name=generator.choice(NAMES), company=generator.choice(COMPANIES), city=generator.choice(CITIES),
+        number=generator.randint(2, 900), amount=generator.randint(100, 9000), day=generator.choice(DAYS),
+        hour=generator.randint(1, 5)
+    )
+    sender = f"{generator.choice(NAMES).lower()}@{generator.choice(COMPANIES).split()[0].lower()}.com"
+    return label, f"Sender: {sender}. Recipient: sales@example.com. Subject: Re: {label}. Content: {body}."
+
+
+def main():
+    semantic_routers = load_step("2_semantic_routers", "semantic_routers")
+    schema = semantic_routers.EmailSentimentAndFunnelStage
+    generator = random.Random(7)
+
+    print(f"{'threshold':>10} {'emails':>7} {'lookup ms':>10} {'reused':>7} {'correct':>8}")
+    for threshold in (0.8, 0.88, 0.92, 0.96):
+        with tempfile.TemporaryDirectory() as directory:
+            index_config = {
+                "path": os.path.join(directory, "index.npz"), "dimensions": 4096, "max_records": 2000,
+                "similarity_threshold": threshold, "audit_rate": 0.0, "reuse_schemas": [schema.__name__],
+            }
+            with contextlib.redirect_stdout(io.StringIO()):
+                index = semantic_routers.NearestNeighborIndex(index_config)
+            emails = 500
+            reused = correct = 0
+            lookup_seconds = 0.0
+            for _ in range(emails):
+                label, input_data = synthetic_email(generator)
+                index.start_run()
+                started = time.perf_counter()
+                answer = index.lookup(input_data, "router prompt", schema)
+                lookup_seconds += time.perf_counter() - started
+                if answer is not None:
+                    reused += 1
+                    correct += answer == {"label": label}
+                index.remember("router prompt", schema, {"label": label})
+                index.save_run()
+            # Accuracy of the reused answers; there is none to report when nothing was reused
+            accuracy = f"{correct / reused:.1%}" if reused else "n/a"
+            print(
+                f"{threshold:>10} {emails:>7} {lookup_seconds / emails * 1000:>10.2f} {reused / emails:>7.1%} "
+                f"{accuracy:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark: how much of the reply drafter's prompt a provider with prompt caching serves from its prefix cache.
+
+Drafts replies to emails from different senders with reply_drafter_and_assembler, over real HTTP through the step's
+HttpTransport, against the local mock OpenAI server (benchmarks/mock_openai_server.py) with its PrefixCache. The
+drafter's system prompt is static text only (common_context, then drafting_config["variable_context"]), and
+everything about the email goes in the user message after it, so every draft after the first should repeat the
+whole system prompt as its cached prefix. Reports the step's own provider_usage: prompt and cached tokens per draft.
+
+    python benchmarks/bench_prompt_cache.py [--emails 10]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import pathlib
+
+from mock_openai_server import LatencyModel, MockOpenAIServer, PrefixCache
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+SENDERS = [
+    ("dana@northwind-properties.com", "We manage about forty buildings and would like a trial account before procurement joins."),
+    ("li@harbor-reit.com", "Could you share a case study for a portfolio our size? We are comparing three vendors this quarter."),
+    ("sam@crestline-realty.com", "Our leasing team is drowning in renewals. Can we set up a call next week to see a demo?"),
+    ("priya@oakgate-capital.com", "A colleague recommended you. What does onboarding look like for a mixed-use portfolio?"),
+]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PipedreamStub:
+    def __init__(self, steps, inputs):
+        self.steps = steps
+        self.inputs = inputs
+        self.exports = {}
+
+    def export(self, name, value):
+        self.exports[name] = value
+
+
+def email_steps(workflow_config, index):
+    sender, body = SENDERS[index % len(SENDERS)]
+    subject = f"Portfolio question #{index}"
+    thread_messages = [[f"m{index}", sender, ["sales@example.com"], subject, "2024-03-01 10:00:00", f"{body} (ref {index})"]]
+    return {
+        "workflow_config": {
+            "drafting_config": workflow_config.drafting_config,
+            "http_transport_config": workflow_config.http_transport_config,
+        },
+        "parse_thread": {"sender": sender, "recipient": "sales@example.com", "subject": subject, "thread_messages": thread_messages},
+        "semantic_routers": {
+            "sensitivity result:": {"isSensitive": 0},
+            "email_scenario_result": {"inquiry_type": "ORGANIC_INBOUND", "sender_category": "ICP_OTHER"},
+            "thread_context": {"summary": None, "thread_messages": thread_messages},
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=10, help="emails to draft replies for")
+    arguments = parser.parse_args()
+
+    workflow_config = load_step("0_workflow_config", "workflow_config")
+    reply_drafter = load_step("3_reply_drafter_and_assembler", "reply_drafter")
+    server = MockOpenAIServer(LatencyModel(median_ms=0), prefix_cache=PrefixCache())
+    workflow_config.http_transport_config = dict(workflow_config.http_transport_config, llm_api_url=server.start())
+
+    print(f"{'email':>6} {'prompt tokens':>14} {'cached tokens':>14} {'cached share':>13}")
+    prompt_total = cached_total = 0
+    for index in range(arguments.emails):
+        pd = PipedreamStub(email_steps(workflow_config, index), {"openai": {"$auth": {"api_key": "sk-benchmark"}}})
+        with contextlib.redirect_stdout(io.StringIO()):
+            reply_drafter.handler(pd)
+        if "error" in pd.exports:
+            raise SystemExit(f"Draft {index} failed: {pd.exports['error']}")
+        usage = pd.exports["token_ledger"]["provider_usage"]
+        prompt_total += usage["prompt_tokens"]
+        cached_total += usage["cached_tokens"]
+        print(f"{index:>6} {usage['prompt_tokens']:>14} {usage['cached_tokens']:>14} {usage['cached_share']:>12.1%}")
+    server.stop()
+
+    share = cached_total / prompt_total if prompt_total else 0.0
+    print(f"{'total':>6} {prompt_total:>14} {cached_total:>14} {share:>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
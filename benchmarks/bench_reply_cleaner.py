@@ -0,0 +1,95 @@
+"""
+Micro-benchmark: ReplyCleaner (parse_thread) against the regex chain it replaced.
+
+The old chain ran remove_quoted_content_plain, remove_signatures and normalize_content back to back, compiling its
+patterns on every call. Both are run over synthetic pasted threads and whitespace-heavy HTML conversions of growing
+size; time per KB should stay flat for ReplyCleaner as the input grows.
+
+    python benchmarks/bench_reply_cleaner.py
+"""
+import importlib.util
+import pathlib
+import re
+import timeit
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_clean(content):
+    # remove_quoted_content_plain + clean_up_content, as they were
+    quoted_line_pattern = re.compile(r'^\s*>+.*$', re.MULTILINE)
+    splitter_pattern = re.compile(
+        r'^\s*[-]+[ ]*Forwarded message[ ]*[-]+\s*$|'
+        r'^\s*[-]+[ ]*Original Message[ ]*[-]+\s*$|'
+        r'^\s*On.*wrote:$|'
+        r'^\s*From:.*$|'
+        r'^\s*Sent:.*$|'
+        r'^\s*To:.*$|'
+        r'^\s*Subject:.*$', re.MULTILINE | re.IGNORECASE)
+    content = re.sub(quoted_line_pattern, '', content)
+    content = re.sub(splitter_pattern, '', content)
+    content = re.sub(r'\n\s*\n', '\n\n', content).strip()
+    # ContentProcessor.remove_signatures
+    content = re.sub(re.compile(r'(--\s*\n.*$)', re.MULTILINE | re.DOTALL), '', content)
+    # ContentProcessor.normalize_content
+    content = re.sub(r'\r\n', '\n', content)
+    content = re.sub(r'[ \t]+', ' ', content)
+    content = re.sub(r'\n{3,}', '\n\n', content)
+    return content
+
+
+def pasted_thread(replies):
+    # A top-posted reply followed by the whole earlier thread, the way Outlook and Gmail paste it
+    body = ["Thanks, Tuesday at 2pm works for us.\n\nCan you send over the deck beforehand?\n"]
+    for index in range(replies):
+        body.append(
+            f"\nFrom: Person {index} <person{index}@example.com>\n"
+            f"Sent: Monday, March {index % 28 + 1}, 2024 10:{index % 60:02d} AM\n"
+            f"To: sales@example.com\nSubject: RE: Pricing for the portfolio\n\n"
+            f"Reply number {index} with some   spacing\tand tabs that need normalizing.\n\n\n\n"
+            f"On Mon, Mar {index % 28 + 1}, 2024 at 9:00 AM Someone <someone@example.com> wrote:\n"
+            + "".join(f"> quoted line {line} of reply {index}\n" for line in range(8))
+        )
+    body.append("\n-- \nJordan Smith\nHead of Sales\n")
+    return "".join(body)
+
+
+def converted_newsletter(blocks):
+    # HTML-to-text output of a table layout: long runs of whitespace-only lines, which the old ^\s* patterns rescan
+    return "".join(f"Section {index} of the newsletter\n" + "   \n" * 200 for index in range(blocks))
+
+
+def main():
+    parse_thread = load_step("1_parse_thread", "parse_thread")
+    cleaner = parse_thread.ReplyCleaner()
+
+    print(f"{'replies':>8} {'size KB':>9} {'legacy ms':>10} {'cleaner ms':>11} {'speedup':>8}")
+    for replies in (10, 100, 1000, 5000):
+        content = pasted_thread(replies)
+        runs = max(1, 2000 // replies)
+        legacy = timeit.timeit(lambda: legacy_clean(content), number=runs) / runs * 1000
+        single_pass = timeit.timeit(lambda: cleaner.clean(content), number=runs) / runs * 1000
+        print(f"{replies:>8} {len(content) / 1024:>9.1f} {legacy:>10.2f} {single_pass:>11.2f} {legacy / single_pass:>7.1f}x")
+
+    print(f"\n{'blocks':>8} {'size KB':>9} {'legacy ms':>10} {'cleaner ms':>11} {'speedup':>8}")
+    for blocks in (1, 10, 50):
+        content = converted_newsletter(blocks)
+        runs = max(1, 50 // blocks)
+        legacy = timeit.timeit(lambda: legacy_clean(content), number=runs) / runs * 1000
+        single_pass = timeit.timeit(lambda: cleaner.clean(content), number=runs) / runs * 1000
+        print(f"{blocks:>8} {len(content) / 1024:>9.1f} {legacy:>10.2f} {single_pass:>11.2f} {legacy / single_pass:>7.1f}x")
+
+    content = pasted_thread(10)
+    print("\nlegacy output:\n" + legacy_clean(content)[:300])
+    print("\ncleaner output:\n" + cleaner.clean(content)[:300])
+
+
+if __name__ == "__main__":
+    main()
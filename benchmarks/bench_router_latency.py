@@ -0,0 +1,111 @@
+"""
+Benchmark: end-to-end router latency of semantic_routers against the local mock OpenAI server
+(benchmarks/mock_openai_server.py), over real HTTP through the step's HttpTransport.
+
+Every email runs the full path of a relevant lead (classification, relevancy, sensitivity, scenario and sentiment)
+in each router mode. The server answers every schema the same way and draws its latency from a lognormal
+distribution; the scenarios add slow stragglers and injected 429/500 errors. Reports p50/p95/p99 per email and
+how many emails failed. No router cache or nearest-neighbor index is used, so every call reaches the server.
+
+    python benchmarks/bench_router_latency.py [--emails 25]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import pathlib
+import statistics
+import time
+
+from mock_openai_server import LatencyModel, MockOpenAIServer
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+SCENARIOS = [
+    # name, median ms, sigma, tail rate, tail ms, error rate
+    ("steady", 100, 0.2, 0.0, 0, 0.0),
+    ("stragglers", 100, 0.4, 0.05, 1000, 0.0),
+    ("errors", 100, 0.4, 0.0, 0, 0.05),
+]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PipedreamStub:
+    def __init__(self, steps, inputs):
+        self.steps = steps
+        self.inputs = inputs
+
+    def export(self, name, value):
+        pass
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        return [samples[0] if samples else 0.0] * 3
+    cut_points = statistics.quantiles(samples, n=100, method="inclusive")
+    return cut_points[49], cut_points[94], cut_points[98]
+
+
+def run_email(semantic_routers, router_class, pd, config, assembled_prompts, http_transport):
+    http_transport.start_run()
+    email_handler = semantic_routers.EmailHandler(pd, config, assembled_prompts, http_transport)
+    router = router_class(email_handler)
+    try:
+        classification_result = router.classification()
+        relevancy_result = router.relevancy()
+        router.sensitivity(classification_result, relevancy_result)
+        router.scenario_and_sentiment()
+    finally:
+        router.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=25, help="emails per router mode and scenario")
+    arguments = parser.parse_args()
+
+    workflow_config = load_step("0_workflow_config", "workflow_config")
+    semantic_routers = load_step("2_semantic_routers", "semantic_routers")
+    assembled_prompts = workflow_config.PromptAssembler(workflow_config.semantic_routers_config).assemble_all_prompts()
+    pd = PipedreamStub(
+        {"parse_thread": {
+            "sender": "lead@example.com", "recipient": "sales@example.com", "subject": "Trial for our portfolio",
+            "thread_messages": [["m0", "lead@example.com", ["sales@example.com"], "Trial for our portfolio", "2024-03-01 10:00:00",
+                                 "We manage about forty buildings and would like a trial account before procurement joins."]],
+        }},
+        {"openai": {"$auth": {"api_key": "sk-benchmark"}}},
+    )
+
+    print(f"{'scenario':>11} {'mode':>12} {'emails':>7} {'failed':>7} {'requests':>9} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+    for name, median_ms, sigma, tail_rate, tail_ms, error_rate in SCENARIOS:
+        for mode, router_class in semantic_routers.ROUTER_MODES.items():
+            server = MockOpenAIServer(LatencyModel(median_ms, sigma, tail_rate, tail_ms), error_rate)
+            transport_config = dict(workflow_config.http_transport_config, llm_api_url=server.start())
+            http_transport = semantic_routers.HttpTransport(transport_config)
+            samples = []
+            failed = 0
+            for _ in range(arguments.emails):
+                started = time.perf_counter()
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        run_email(semantic_routers, router_class, pd, workflow_config.semantic_routers_config, assembled_prompts, http_transport)
+                except Exception:
+                    failed += 1
+                    continue
+                samples.append(time.perf_counter() - started)
+            server.stop()
+            p50, p95, p99 = percentiles(samples)
+            print(
+                f"{name:>11} {mode:>12} {arguments.emails:>7} {failed:>7} {server.stats()['requests']:>9} "
+                f"{p50:>7.2f} {p95:>7.2f} {p99:>7.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark: semantic router modes (semantic_routers_config["router_mode"]) on the path of a relevant lead, where every
+router runs.
+
+The model is simulated: each call sleeps for a fixed time to first token plus per-token prefill and decode times, and
+answers every schema with a fixed result. Billed tokens are the system prompt, the input and the answer of every call,
+so the cascade pays for the thread once per router and the fused mode once in total. The speculative mode bills what
+the cascade does but waits only for the slowest call.
+
+    python benchmarks/bench_router_modes.py
+"""
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import pathlib
+import time
+
+import tiktoken
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+FIRST_TOKEN_SECONDS = 0.25
+PREFILL_SECONDS_PER_TOKEN = 0.00002
+DECODE_SECONDS_PER_TOKEN = 0.01
+
+ANSWERS = {
+    "EmailClassification": {"requiresResponse": 1},
+    "EmailRelevancy": {"isRelevant": 1},
+    "EmailSensitivity": {"isSensitive": 0},
+    "EmailSentimentAndFunnelStage": {"label": "interested"},
+    "EmailScenario": {"inquiry_type": "ORGANIC_INBOUND", "sender_category": "ICP_OTHER"},
+}
+ANSWERS["EmailRouting"] = {field: value for answer in ANSWERS.values() for field, value in answer.items()}
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SimulatedModel:
+    def __init__(self):
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.calls = 0
+        self.tokens = 0
+
+    def answer(self, prompt, system, output_schema):
+        result = ANSWERS[output_schema.__name__]
+        prompt_tokens = len(self.encoding.encode(system)) + len(self.encoding.encode(prompt))
+        output_tokens = len(self.encoding.encode(json.dumps(result)))
+        self.calls += 1
+        self.tokens += prompt_tokens + output_tokens
+        return dict(result), FIRST_TOKEN_SECONDS + prompt_tokens * PREFILL_SECONDS_PER_TOKEN + output_tokens * DECODE_SECONDS_PER_TOKEN
+
+    def install(self, semantic_routers):
+        model = self
+
+        def call(chat, prompt, system=None, output_schema=None, **kwargs):
+            result, seconds = model.answer(prompt, system, output_schema)
+            time.sleep(seconds)
+            return result
+
+        async def call_async(chat, prompt, system=None, output_schema=None, **kwargs):
+            result, seconds = model.answer(prompt, system, output_schema)
+            await asyncio.sleep(seconds)
+            return result
+
+        semantic_routers.AIChat.__call__ = call
+        semantic_routers.AsyncAIChat.__call__ = call_async
+
+
+class PipedreamStub:
+    def __init__(self, steps, inputs):
+        self.steps = steps
+        self.inputs = inputs
+
+    def export(self, name, value):
+        pass
+
+
+def thread_rows(messages):
+    body = "Thanks for the walkthrough yesterday. We manage about forty buildings and want to see how the lease " \
+           "abstraction handles our older contracts before we bring in procurement. Could we get a trial account?"
+    return [
+        [f"m{index}", "lead@example.com", ["sales@example.com"], "Trial for our portfolio", "2024-03-01 10:00:00", f"{body} ({index})"]
+        for index in range(messages)
+    ]
+
+
+def main():
+    workflow_config = load_step("0_workflow_config", "workflow_config")
+    semantic_routers = load_step("2_semantic_routers", "semantic_routers")
+    assembled_prompts = workflow_config.PromptAssembler(workflow_config.semantic_routers_config).assemble_all_prompts()
+    http_transport = semantic_routers.HttpTransport(workflow_config.http_transport_config)
+
+    print(f"{'messages':>9} {'mode':>12} {'calls':>6} {'tokens':>8} {'seconds':>8}")
+    for messages in (3, 10, 30):
+        pd = PipedreamStub(
+            {"parse_thread": {"sender": "lead@example.com", "recipient": "sales@example.com", "subject": "Trial", "thread_messages": thread_rows(messages)}},
+            {"openai": {"$auth": {"api_key": "sk-benchmark"}}},
+        )
+        for mode, router_class in semantic_routers.ROUTER_MODES.items():
+            model = SimulatedModel()
+            model.install(semantic_routers)
+            with contextlib.redirect_stdout(io.StringIO()):
+                email_handler = semantic_routers.EmailHandler(pd, workflow_config.semantic_routers_config, assembled_prompts, http_transport)
+                router = router_class(email_handler)
+                started = time.perf_counter()
+                classification_result = router.classification()
+                relevancy_result = router.relevancy()
+                router.sensitivity(classification_result, relevancy_result)
+                router.scenario_and_sentiment()
+                elapsed = time.perf_counter() - started
+                router.finish()
+            print(f"{messages:>9} {mode:>12} {model.calls:>6} {model.tokens:>8} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
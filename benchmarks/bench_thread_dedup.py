@@ -0,0 +1,64 @@
+"""
+Micro-benchmark: cross-message repeat removal in parse_thread (ContentProcessor.remove_repeated_paragraphs).
+
+Synthetic threads from a client that top-posts without ">" markers: every reply carries the full text of all earlier
+replies. Reports bytes and tokens before and after, and the time per KB of input, which should stay flat as the
+thread grows.
+
+    python benchmarks/bench_thread_dedup.py
+"""
+import contextlib
+import importlib.util
+import io
+import pathlib
+import time
+
+import tiktoken
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def top_posted_thread(messages):
+    replies = [
+        f"Reply {index}: thanks for the update on the portfolio, we reviewed suite {index * 7} and the terms for "
+        f"building {index % 5} look workable if the start date can move to the first of month {index % 12 + 1}."
+        for index in range(messages)
+    ]
+    return ["\n\n".join(reversed(replies[:index + 1])) for index in range(messages)]
+
+
+def main():
+    parse_thread = load_step("1_parse_thread", "parse_thread")
+    encoding = tiktoken.get_encoding("cl100k_base")
+    compactor = parse_thread.ThreadCompactor(max_tokens=0)
+
+    print(f"{'messages':>9} {'KB before':>10} {'KB after':>9} {'tokens before':>14} {'tokens after':>13} {'ms':>8} {'us/KB':>7}")
+    for messages in (10, 50, 100, 200):
+        bodies = top_posted_thread(messages)
+        thread = [
+            parse_thread.ThreadMessage(f"m{index}", "client@example.com", ["sales@example.com"], "Portfolio", "", body)
+            for index, body in enumerate(bodies)
+        ]
+        size_before = sum(len(body.encode()) for body in bodies)
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            deduplicated, _ = compactor.remove_repeated_paragraphs(thread)
+            elapsed = time.perf_counter() - started
+        size_after = sum(len(message.body.encode()) for message in deduplicated)
+        tokens_before = sum(len(encoding.encode(body)) for body in bodies)
+        tokens_after = sum(len(encoding.encode(message.body)) for message in deduplicated)
+        print(
+            f"{messages:>9} {size_before / 1024:>10.1f} {size_after / 1024:>9.1f} {tokens_before:>14} "
+            f"{tokens_after:>13} {elapsed * 1000:>8.2f} {elapsed * 1e6 / (size_before / 1024):>7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
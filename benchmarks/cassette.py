@@ -0,0 +1,231 @@
+"""
+Record and replay of the workflow's HTTP traffic, for benchmarks/replay_workflow.py. install() hooks the lowest layer
+of every HTTP library the steps use (requests adapters for Gmail, httpx transports for OpenAI, the urllib3 pool
+manager for HubSpot), so the steps' pooled transports, rate limiters, retries and counters run unchanged above it
+and the steps themselves carry no record/replay code.
+"""
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+
+import httpx
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+class Cassette:
+    """
+    One step's HTTP traffic in a .jsonl.gz file. "record" starts a new file and appends every exchange to it; "replay"
+    serves them back in recorded order, matched on method, URL and request body (then on method and URL alone),
+    without touching the network. Only responses are stored: request headers, and with them the access tokens, never
+    reach the cassette.
+    """
+    # The stored body is already decoded, and its length is recomputed when it is served again
+    DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+    def __init__(self, path, mode, zero_timing=False):
+        self.path = path
+        self.mode = mode
+        self.zero_timing = zero_timing
+        self.lock = threading.Lock()
+        self.exchanges = []
+        self.index = {}
+        self.served = set()
+        self.counters = {"recorded": 0, "replayed": 0, "missed": 0}
+        if mode == "replay":
+            with gzip.open(path, "rt", encoding="utf-8") as cassette_file:
+                self.exchanges = [json.loads(line) for line in cassette_file if line.strip()]
+            for position, exchange in enumerate(self.exchanges):
+                self.index.setdefault((exchange["method"], exchange["url"]), []).append(position)
+        else:
+            # A replay never meets the exchanges of an earlier recording
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            gzip.open(path, "wt", encoding="utf-8").close()
+
+    @staticmethod
+    def body_digest(body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        return hashlib.sha256(body or b"").hexdigest()
+
+    def record(self, method, url, body, status, reason, headers, content, seconds):
+        exchange = {
+            "method": method,
+            "url": url,
+            "body_digest": self.body_digest(body),
+            "status": status,
+            "reason": reason,
+            "headers": {name: value for name, value in headers.items() if name.lower() not in self.DROPPED_HEADERS},
+            "content": base64.b64encode(content).decode("ascii"),
+            "seconds": round(seconds, 4),
+        }
+        with self.lock:
+            # Appending writes one gzip member per exchange; gzip.open reads them back as a single stream
+            with gzip.open(self.path, "at", encoding="utf-8") as cassette_file:
+                cassette_file.write(json.dumps(exchange) + "\n")
+            self.counters["recorded"] += 1
+        return exchange
+
+    def replay(self, method, url, body):
+        # The first unserved exchange with the same body, else the first unserved one for the URL; once all are
+        # served the last one repeats. None when the URL was never recorded
+        digest = self.body_digest(body)
+        with self.lock:
+            positions = self.index.get((method, url), [])
+            exact = [position for position in positions if self.exchanges[position]["body_digest"] == digest]
+            position = next(
+                (position for candidates in (exact, positions) for position in candidates if position not in self.served),
+                (exact or positions or [None])[-1]
+            )
+            if position is None:
+                self.counters["missed"] += 1
+                return None
+            self.served.add(position)
+            self.counters["replayed"] += 1
+            return self.exchanges[position]
+
+    def delay(self, exchange):
+        return 0 if self.zero_timing else exchange["seconds"]
+
+    @staticmethod
+    def content(exchange):
+        return base64.b64decode(exchange["content"])
+
+    def stats(self):
+        with self.lock:
+            return {"mode": self.mode, **self.counters}
+
+
+# The cassette of the step that is running; None lets every request through untouched
+active = {"cassette": None}
+
+
+def use(cassette):
+    active["cassette"] = cassette
+
+
+def requests_response(cassette, exchange, request):
+    response = requests.Response()
+    response.status_code = exchange["status"]
+    response.reason = exchange["reason"]
+    response.headers = CaseInsensitiveDict(exchange["headers"])
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = cassette.content(exchange)
+    response.url = request.url
+    response.request = request
+    response.elapsed = timedelta(seconds=exchange["seconds"])
+    return response
+
+
+def httpx_response(cassette, exchange, request):
+    # Recorded and replayed calls hand the client the same rebuilt response, decoded body included. The body goes in
+    # as a stream so the client reads and closes it as usual, which is also what sets response.elapsed
+    return httpx.Response(
+        exchange["status"], headers=exchange["headers"], stream=httpx.ByteStream(cassette.content(exchange)), request=request
+    )
+
+
+def urllib3_response(cassette, exchange, method, url):
+    return urllib3.HTTPResponse(
+        body=cassette.content(exchange), headers=exchange["headers"], status=exchange["status"],
+        reason=exchange["reason"], request_method=method, request_url=url
+    )
+
+
+def install():
+    original_send = HTTPAdapter.send
+    original_handle_request = httpx.HTTPTransport.handle_request
+    original_handle_async_request = httpx.AsyncHTTPTransport.handle_async_request
+    original_urlopen = urllib3.PoolManager.urlopen
+
+    def send(adapter, request, **kwargs):
+        cassette = active["cassette"]
+        if cassette is None:
+            return original_send(adapter, request, **kwargs)
+        if cassette.mode == "replay":
+            exchange = cassette.replay(request.method, request.url, request.body)
+            if exchange is None:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+            time.sleep(cassette.delay(exchange))
+            return requests_response(cassette, exchange, request)
+        started = time.perf_counter()
+        response = original_send(adapter, request, **kwargs)
+        cassette.record(
+            request.method, request.url, request.body, response.status_code, response.reason, response.headers,
+            response.content, time.perf_counter() - started
+        )
+        return response
+
+    def handle_request(transport, request):
+        cassette = active["cassette"]
+        if cassette is None:
+            return original_handle_request(transport, request)
+        if cassette.mode == "replay":
+            exchange = cassette.replay(request.method, str(request.url), request.read())
+            if exchange is None:
+                raise httpx.ConnectError(f"No recorded response for {request.method} {request.url}", request=request)
+            time.sleep(cassette.delay(exchange))
+            return httpx_response(cassette, exchange, request)
+        started = time.perf_counter()
+        response = original_handle_request(transport, request)
+        content = response.read()
+        response.close()
+        exchange = cassette.record(
+            request.method, str(request.url), request.read(), response.status_code, response.reason_phrase,
+            response.headers, content, time.perf_counter() - started
+        )
+        return httpx_response(cassette, exchange, request)
+
+    async def handle_async_request(transport, request):
+        cassette = active["cassette"]
+        if cassette is None:
+            return await original_handle_async_request(transport, request)
+        if cassette.mode == "replay":
+            exchange = cassette.replay(request.method, str(request.url), await request.aread())
+            if exchange is None:
+                raise httpx.ConnectError(f"No recorded response for {request.method} {request.url}", request=request)
+            await asyncio.sleep(cassette.delay(exchange))
+            return httpx_response(cassette, exchange, request)
+        started = time.perf_counter()
+        response = await original_handle_async_request(transport, request)
+        content = await response.aread()
+        await response.aclose()
+        exchange = cassette.record(
+            request.method, str(request.url), await request.aread(), response.status_code, response.reason_phrase,
+            response.headers, content, time.perf_counter() - started
+        )
+        return httpx_response(cassette, exchange, request)
+
+    def urlopen(pool_manager, method, url, redirect=True, **kw):
+        # requests goes through connection pools directly, so only direct urllib3 users (the HubSpot clients) get here
+        cassette = active["cassette"]
+        if cassette is None:
+            return original_urlopen(pool_manager, method, url, redirect=redirect, **kw)
+        if cassette.mode == "replay":
+            exchange = cassette.replay(method, url, kw.get("body"))
+            if exchange is None:
+                raise urllib3.exceptions.ProtocolError(f"No recorded response for {method} {url}")
+            time.sleep(cassette.delay(exchange))
+            return urllib3_response(cassette, exchange, method, url)
+        started = time.perf_counter()
+        response = original_urlopen(pool_manager, method, url, redirect=redirect, **kw)
+        # .data reads the body even when the caller asked for preload_content=False, and keeps it for the caller
+        cassette.record(
+            method, url, kw.get("body"), response.status, response.reason, response.headers, response.data,
+            time.perf_counter() - started
+        )
+        return response
+
+    HTTPAdapter.send = send
+    httpx.HTTPTransport.handle_request = handle_request
+    httpx.AsyncHTTPTransport.handle_async_request = handle_async_request
+    urllib3.PoolManager.urlopen = urlopen
@@ -0,0 +1,220 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, for benchmarking semantic_routers and the reply drafter
+without paying for GPT-4 or living with its latency.
+
+Answers the way simpleaichat expects: a function_call whose arguments fit the requested output schema, or plain
+assistant content when no schema is sent (thread summaries, drafts). The router schemas get fixed answers, any other
+schema gets one built from its JSON schema, so every run is deterministic. Latency is drawn from a lognormal
+distribution around a median, with an optional share of slow responses, and a share of requests can fail with a
+429 or 500 in OpenAI's error shape. With a PrefixCache the usage block reports cached_tokens the way OpenAI's prompt
+caching does.
+
+Run it on its own and set http_transport_config["llm_api_url"] to the printed URL:
+
+    python benchmarks/mock_openai_server.py --port 8089 --median-ms 800 --error-rate 0.02
+"""
+import argparse
+import http.server
+import json
+import math
+import random
+import threading
+import time
+
+ANSWERS = {
+    "EmailClassification": {"requiresResponse": 1},
+    "EmailRelevancy": {"isRelevant": 1},
+    "EmailSensitivity": {"isSensitive": 0},
+    "EmailSentimentAndFunnelStage": {"label": "interested"},
+    "EmailScenario": {"inquiry_type": "ORGANIC_INBOUND", "sender_category": "ICP_OTHER"},
+}
+ANSWERS["EmailRouting"] = {field: value for answer in ANSWERS.values() for field, value in answer.items()}
+
+SCHEMA_DEFAULTS = {"integer": 0, "number": 0.0, "boolean": False, "string": "", "array": [], "object": {}}
+TEXT_ANSWER = "Thanks for reaching out. Here is a short, deterministic reply from the local benchmark server."
+
+
+def schema_answer(parameters):
+    # First enum value or a type default for every property, for schemas without a fixed answer
+    answer = {}
+    for field, spec in parameters.get("properties", {}).items():
+        if spec.get("enum"):
+            answer[field] = spec["enum"][0]
+        else:
+            answer[field] = spec.get("default", SCHEMA_DEFAULTS.get(spec.get("type"), ""))
+    return answer
+
+
+class LatencyModel:
+    """
+    Lognormal response times around median_ms; sigma sets the spread. A tail_rate share of responses takes
+    tail_ms on top, standing in for the occasional slow completion that drives p99.
+    """
+    def __init__(self, median_ms=800, sigma=0.4, tail_rate=0.0, tail_ms=0, seed=7):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def seconds(self):
+        with self.lock:
+            milliseconds = self.median_ms * math.exp(self.random.gauss(0, self.sigma)) if self.median_ms else 0
+            if self.random.random() < self.tail_rate:
+                milliseconds += self.tail_ms
+            return milliseconds / 1000
+
+
+class PrefixCache:
+    """
+    OpenAI's prompt caching as the usage block reports it: prompts of min_tokens or more are cached in prefixes of
+    min_tokens plus whole blocks of block_tokens, and a request reports the longest prefix an earlier request already
+    sent, byte for byte. The prefix covers the functions and then the messages in order. Tokens are counted as four
+    characters, like the rest of this server.
+    """
+    def __init__(self, min_tokens=1024, block_tokens=128):
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def prompt_text(request):
+        messages = "".join(f"{message.get('role')}:{message.get('content') or ''}" for message in request.get("messages", []))
+        return json.dumps(request.get("functions", [])) + messages
+
+    def cached_tokens(self, request):
+        text = self.prompt_text(request)
+        prefix_lengths = range(self.min_tokens, len(text) // 4 + 1, self.block_tokens)
+        cached = 0
+        with self.lock:
+            for tokens in prefix_lengths:
+                prefix = hash(text[:tokens * 4])
+                if prefix in self.seen:
+                    cached = tokens
+                self.seen.add(prefix)
+        return cached
+
+
+class MockOpenAIServer:
+    def __init__(self, latency=None, error_rate=0.0, host="127.0.0.1", port=0, seed=7, prefix_cache=None):
+        self.latency = latency or LatencyModel(seed=seed)
+        self.error_rate = error_rate
+        self.prefix_cache = prefix_cache
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0}
+        self.server = http.server.ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.api_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fails(self):
+        with self.lock:
+            self.counters["requests"] += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.counters["errors"] += 1
+            return failed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def completion(self, request):
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in request.get("messages", [])) // 4
+        message = {"role": "assistant", "content": TEXT_ANSWER}
+        function_call = request.get("function_call")
+        if isinstance(function_call, dict):
+            name = function_call["name"]
+            parameters = next((function.get("parameters", {}) for function in request.get("functions", []) if function.get("name") == name), {})
+            prompt_tokens += len(json.dumps(request.get("functions", []))) // 4
+            message = {"role": "assistant", "content": None, "function_call": {
+                "name": name, "arguments": json.dumps(ANSWERS.get(name) or schema_answer(parameters))
+            }}
+        completion_tokens = len(json.dumps(message)) // 4
+        cached_tokens = min(self.prefix_cache.cached_tokens(request), prompt_tokens) if self.prefix_cache else 0
+        return {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4-0125-preview"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "function_call" if function_call else "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def handler_class(self):
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                time.sleep(mock.latency.seconds())
+                if mock.fails():
+                    status = mock.random.choice([429, 500])
+                    body = {"error": {"message": "Injected failure", "type": "server_error" if status == 500 else "rate_limit_exceeded"}}
+                else:
+                    status, body = 200, mock.completion(request)
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on the call, e.g. a speculative router cancelling what it no longer needs
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--median-ms", type=float, default=800)
+    parser.add_argument("--sigma", type=float, default=0.4)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--prefix-cache", action="store_true", help="report cached_tokens like OpenAI's prompt caching")
+    arguments = parser.parse_args()
+
+    latency = LatencyModel(arguments.median_ms, arguments.sigma, arguments.tail_rate, arguments.tail_ms, arguments.seed)
+    prefix_cache = PrefixCache() if arguments.prefix_cache else None
+    server = MockOpenAIServer(latency, arguments.error_rate, arguments.host, arguments.port, arguments.seed, prefix_cache)
+    print(f"Serving chat completions at {server.api_url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Runs the whole workflow (workflow_config, parse_thread, semantic_routers, reply_drafter_and_assembler,
+sending_manager, hubspot_crm_update) locally against recorded traffic, for profiling without network access.
+
+Record once with real credentials, then replay as often as needed:
+
+    GMAIL_TOKEN=... OPENAI_API_KEY=... HUBSPOT_TOKEN=... \\
+        python benchmarks/replay_workflow.py --trigger event.json --mode record
+    python benchmarks/replay_workflow.py --trigger event.json --mode replay --timing zero --profile
+
+Recording is a real run against the live accounts: it pays for the OpenAI calls and semantic_routers labels the
+Gmail thread. sending_manager would create a draft or send the reply and hubspot_crm_update would write to HubSpot,
+so a recording stops before them unless --live-writes is given. Record with a test mailbox and CRM portal, never with
+a customer's. A replay makes no network calls at all.
+
+event.json is the trigger's "event" object as shown in the Pipedream inspector. The steps' HTTP traffic goes to
+one cassette per step under --directory (see benchmarks/cassette.py); a recording replaces the previous one. The
+local stores (router cache, nearest-neighbor index, thread summaries, message store) are moved into a fresh
+temporary directory on every run, so a replay makes the same calls the recording did. Reports the wall time of
+every step and, with --profile, the functions with the most cumulative time.
+"""
+import argparse
+import cProfile
+import importlib.util
+import io
+import json
+import os
+import pathlib
+import pstats
+import tempfile
+import time
+
+import cassette
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# Steps whose recording sends mail, creates drafts or updates the CRM
+LIVE_WRITE_STEPS = {"sending_manager", "hubspot_crm_update"}
+
+STEPS = [
+    ("workflow_config", "0_workflow_config"),
+    ("parse_thread", "1_parse_thread"),
+    ("semantic_routers", "2_semantic_routers"),
+    ("reply_drafter_and_assembler", "3_reply_drafter_and_assembler"),
+    ("sending_manager", "4_sending_manager"),
+    ("hubspot_crm_update", "5_hubspot_crm_update"),
+]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FlowExit(Exception):
+    pass
+
+
+class Flow:
+    def exit(self, reason):
+        raise FlowExit(reason)
+
+
+class PipedreamStub:
+    def __init__(self, trigger_event, inputs):
+        self.steps = {"trigger": {"event": trigger_event}}
+        self.inputs = inputs
+        self.flow = Flow()
+        self.current_step = None
+
+    def export(self, name, value):
+        self.steps.setdefault(self.current_step, {})[name] = value
+
+
+def move_local_stores(value, directory):
+    # Every config entry with a "path" is a local store or cache file
+    if isinstance(value, dict):
+        if isinstance(value.get("path"), str):
+            value["path"] = os.path.join(directory, os.path.basename(value["path"]))
+        for item in value.values():
+            move_local_stores(item, directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trigger", required=True, help="trigger event JSON")
+    parser.add_argument("--mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--timing", choices=["original", "zero"], default="original")
+    parser.add_argument("--directory", default=str(ROOT / "benchmarks" / "cassettes"))
+    parser.add_argument("--profile", action="store_true", help="print the top functions of every step")
+    parser.add_argument(
+        "--live-writes", action="store_true",
+        help="with --mode record, also run sending_manager and hubspot_crm_update, which send mail and write to HubSpot"
+    )
+    arguments = parser.parse_args()
+
+    with open(arguments.trigger) as trigger_file:
+        trigger_event = json.load(trigger_file)
+    inputs = {
+        "gmail_custom_oauth": {"$auth": {"oauth_access_token": os.environ.get("GMAIL_TOKEN", "replay")}},
+        "openai": {"$auth": {"api_key": os.environ.get("OPENAI_API_KEY", "replay")}},
+        "hubspot_developer_app": {"$auth": {"oauth_access_token": os.environ.get("HUBSPOT_TOKEN", "replay")}},
+    }
+    pd = PipedreamStub(trigger_event, inputs)
+    if arguments.mode == "record":
+        print("Recording against the live Gmail, OpenAI and HubSpot accounts; the thread will be labelled")
+
+    cassette.install()
+    with tempfile.TemporaryDirectory() as store_directory:
+        print(f"{'step':>28} {'seconds':>8}  outcome")
+        for step_name, directory in STEPS:
+            if arguments.mode == "record" and step_name in LIVE_WRITE_STEPS and not arguments.live_writes:
+                print(f"{step_name:>28} {'':>8}  not recorded: it writes to the live accounts (see --live-writes)")
+                break
+            cassette_path = os.path.join(arguments.directory, f"{step_name}.jsonl.gz")
+            if arguments.mode == "replay" and not os.path.exists(cassette_path):
+                hint = " (recorded without --live-writes)" if step_name in LIVE_WRITE_STEPS else ""
+                print(f"{step_name:>28} {'':>8}  no cassette at {cassette_path}{hint}")
+                break
+            step_cassette = cassette.Cassette(cassette_path, arguments.mode, arguments.timing == "zero")
+            cassette.use(step_cassette)
+            module = load_step(directory, step_name)
+            pd.current_step = step_name
+            profiler = cProfile.Profile() if arguments.profile else None
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                module.handler(pd)
+            except FlowExit as exit_reason:
+                outcome = f"exit: {exit_reason}"
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            elapsed = time.perf_counter() - started
+            if outcome == "ok" and step_name not in pd.steps:
+                # Steps that skip a message return without exporting, and the steps after them cannot run
+                outcome = "returned without exports"
+            if step_name == "workflow_config":
+                move_local_stores(pd.steps["workflow_config"], store_directory)
+            if step_name == "semantic_routers":
+                # hubspot_crm_update still reads the routers' results under the step's former name
+                pd.steps["parallel_function_call_sentiment_analysis"] = pd.steps.get(step_name, {})
+            print(f"{step_name:>28} {elapsed:>8.3f}  {outcome} {step_cassette.stats()}")
+            if profiler is not None:
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(15)
+                print(report.getvalue())
+            if outcome != "ok":
+                break
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,10 @@ semantic_routers_config = {
             "ICP_OTHER": "Label_n"
         }
     },
+    # "cascade": one model call per router, in order, stopping at the first gate that exits the workflow
+    # "fused": every router decision from one structured-output call (assembled_prompts["email_routing"])
+    # "speculative": every router call started at once; calls a gate makes unnecessary are cancelled
+    "router_mode": "cascade",
     "router_prompts": {
         "email_classification": """
         Function: Email Classification
@@ -71,6 +75,64 @@ semantic_routers_config = {
         - sender category options: {EmailScenarioSenderCategory}
         """
     },
+    # Header rules checked before any model call; a message whose matched rule weights reach min_score is labelled
+    # NOT_FROM_REAL_PERSON and the workflow exits. A weight of 0 turns a rule off
+    "prefilter": {
+        "enabled": 1,  # 0 for off, 1 for on
+        "min_score": 2,
+        "rules": {
+            "list_unsubscribe": 1,  # also sent by sales sequencing tools, so not enough on its own
+            "precedence_bulk": 2,
+            "auto_submitted": 2,  # any Auto-Submitted value but "no", out-of-office replies included
+            "noreply_sender": 2,
+            "esp_return_path": 1,  # also used by some real people's mail tools, so not enough on its own
+            "dsn_mime_type": 2
+        },
+        "precedence_values": ["bulk", "junk", "list"],
+        # Matched inside the sender's local part with everything but letters and digits removed
+        "noreply_senders": ["noreply", "donotreply", "mailerdaemon", "postmaster", "notification", "bounce"],
+        "esp_return_path_domains": [
+            "sendgrid.net", "mailgun.org", "amazonses.com", "mcsv.net", "mcdlv.net", "rsgsv.net",
+            "mandrillapp.com", "sparkpostmail.com", "mktomail.com", "hubspotemail.net", "mailjet.com"
+        ],
+        "dsn_mime_types": ["multipart/report", "message/delivery-status", "message/disposition-notification"]
+    },
+    # Cached router answers, so a reprocessed thread or repeated template is not sent to the model again
+    "router_cache": {
+        "enabled": 1,  # 0 for off, 1 for on
+        "path": "/tmp/semantic_routers_result_cache.sqlite3",
+        "max_records": 5000,  # least recently used results are evicted past this
+        "ttl_hours": 72  # older results are sent to the model again
+    },
+    # Local nearest-neighbor router (needs NumPy): answers given for a near-duplicate past email are reused instead of
+    # calling the model
+    "neighbor_index": {
+        "enabled": 1,  # 0 for off, 1 for on
+        "path": "/tmp/semantic_routers_neighbor_index.npz",
+        "dimensions": 4096,  # hashed char n-gram buckets per email
+        "max_records": 2000,  # least recently used emails are evicted past this
+        "similarity_threshold": 0.92,  # cosine similarity the nearest email needs before its answers are reused
+        "audit_rate": 0.1,  # share of reuses still sent to the model to measure agreement
+        # EmailScenario is left out: its sender_category depends on who sent the email, not on what it says
+        "reuse_schemas": ["EmailClassification", "EmailRelevancy", "EmailSensitivity", "EmailSentimentAndFunnelStage"]
+    },
+    # Rolling summary of older messages, so long threads are not resent in full on every new reply
+    "thread_summary": {
+        "enabled": 1,  # 0 for off, 1 for on
+        "path": "/tmp/semantic_routers_thread_summaries.sqlite3",
+        "recent_messages": 3,  # newest messages always sent word for word
+        "max_uncovered_messages": 4,  # older messages the summary may fall behind by before it is regenerated
+        "prompt": """
+        Function: Thread Summary
+        Summarize the email thread below for a sales assistant that will read it instead of the original messages.
+        If a summary so far is given, update it with the new messages rather than starting over.
+
+        Ruleset:
+        - Keep names, companies, dates, prices, commitments, open questions and agreed next steps.
+        - Note who said what when it matters for the next reply.
+        - Plain text, at most 200 words.
+        """
+    },
     "inquiry_types": "{EmailScenarioInquiryType}",
     "sender_categories": "{EmailScenarioSenderCategory}",
 
@@ -428,11 +490,58 @@ sending_manager_config = {
     "draft_or_autosend": 0  # 0 for draft, 1 for autosend
 }
 
+http_transport_config = {
+    # Pooled keep-alive connections shared by the Gmail, OpenAI and HubSpot calls in every step
+    "pool_size": 10,  # connections kept open per host
+    "connect_timeout": 5,  # seconds
+    "read_timeout": 30,  # seconds, Gmail and HubSpot calls
+    "llm_read_timeout": 180,  # seconds, OpenAI completions
+    # OpenAI-compatible chat completions endpoint; point it at benchmarks/mock_openai_server.py to run the routers
+    # and the drafter without calling OpenAI
+    "llm_api_url": "https://api.openai.com/v1/chat/completions"
+}
+
+gmail_client_config = {
+    "max_concurrency": 8,  # most Gmail API requests any step keeps in flight at once
+    # Gmail allows 250 per user. Each step process has its own bucket, so this caps one step of one run, not the
+    # mailbox: concurrent runs and other clients can still reach Gmail's limit, which its 429s then enforce
+    "quota_units_per_second": 200,
+    "max_retries": 5,  # for 429 and rateLimitExceeded responses, and for 5xx responses to reads
+    "backoff_base_seconds": 1,
+    "backoff_max_seconds": 32
+}
+
+parse_thread_config = {
+    # HTML-to-text backend: "auto" (selectolax, then lxml, then beautifulsoup), or one of those names
+    "html_to_text_backend": "auto",
+    # Bodies are cut at these sizes before parsing; the thread keeps its newest messages first (0 for no limit)
+    "size_budget": {
+        "max_message_bytes": 262144,
+        "max_thread_bytes": 524288
+    },
+    # Token budget for the exported thread: the newest messages stay word for word, older ones are shortened or dropped
+    "compaction": {
+        "max_tokens": 6000,  # 0 for no limit (duplicate paragraphs are still removed)
+        "keep_recent_messages": 3
+    },
+    # Local store of already-cleaned messages so a new reply only parses the messages that are new
+    "message_store": {
+        "enabled": 1,  # 0 for off, 1 for on
+        "path": "/tmp/parse_thread_message_store.sqlite3",
+        "max_records": 5000,  # least recently used records are evicted past this
+        "max_age_days": 14,
+        "max_incremental_fetches": 3  # more new messages than this and the whole thread is fetched in one call
+    }
+}
+
 def handler(pd: "pipedream"):
     # Export the configuration for use in downstream steps
     print("Config Exported.")
     pd.export("semantic_routers_config", semantic_routers_config)
     pd.export("drafting_config", drafting_config)
     pd.export("sending_manager_config", sending_manager_config)
+    pd.export("parse_thread_config", parse_thread_config)
+    pd.export("gmail_client_config", gmail_client_config)
+    pd.export("http_transport_config", http_transport_config)
     #pd.export("hubspot_crm_config", hubspot_crm_config)
 
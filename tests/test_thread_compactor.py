@@ -0,0 +1,66 @@
+"""
+ThreadCompactor.fit keeps the rendered thread, markers included, within the token budget and reports its real size.
+
+    python -m pytest tests
+"""
+import importlib.util
+import pathlib
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+def load_step(directory, name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "workflow" / directory / "entry.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+parse_thread = load_step("1_parse_thread", "parse_thread")
+
+
+def build_thread(messages=12, points=3):
+    # Every message has its own wording, so no paragraph is replaced by a back-reference and only fit() shrinks it
+    return [
+        parse_thread.ThreadMessage(
+            f"m{index}", f"person{index}@example.com", ["sales@example.com"], "Portfolio", f"2024-03-{index + 1:02d}",
+            "\n\n".join(
+                f"Message {index}, point {point}: suite {index * 10 + point} on floor {point} needs a walkthrough, "
+                f"and the invoice for month {index + point} is still pending with accounting."
+                for point in range(points)
+            )
+        )
+        for index in range(messages)
+    ]
+
+
+@pytest.mark.parametrize("max_tokens", [450, 600, 900, 1500])
+def test_fit_stays_within_budget_and_reports_rendered_sizes(max_tokens):
+    compactor = parse_thread.ThreadCompactor(max_tokens=max_tokens)
+    compacted, token_counts, _ = compactor.fit(build_thread())
+
+    assert sum(token_counts) <= max_tokens
+    assert token_counts == [compactor.count_tokens(message.render()) for message in compacted]
+
+
+def test_fit_shortens_within_budget():
+    # One long older message before the newest three leaves room to shorten it rather than drop it
+    thread = build_thread(1, points=30) + build_thread(4)[1:]
+    compactor = parse_thread.ThreadCompactor(max_tokens=600)
+    compacted, token_counts, shortened = compactor.fit(thread)
+
+    assert shortened == 1
+    assert compacted[0].body.endswith(compactor.SHORTENED_NOTE)
+    assert sum(token_counts) <= 600
+    assert token_counts == [compactor.count_tokens(message.render()) for message in compacted]
+
+
+def test_compact_exports_rendered_size():
+    compactor = parse_thread.ThreadCompactor(max_tokens=450)
+    compacted = compactor.compact(build_thread())
+
+    rendered_tokens = sum(compactor.count_tokens(message.render()) for message in compacted)
+    assert compactor.stats()["tokens_after"] == rendered_tokens <= 450
+    assert compactor.stats()["messages_dropped"] > 0
@@ -1,13 +1,205 @@
+import asyncio
 import base64
+import codecs
+import json
+import random
 import re
+import sqlite3
+import threading
+import time
 import requests
+import tiktoken
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
 from dateutil.parser import parse
 
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+class ReplyCleaner:
+    """
+    Single-pass, line-oriented cleanup of a message body. Quoted lines, "On ... wrote:" and forward/original-message
+    splitters and Outlook header lines are dropped, everything from the signature delimiter on is cut, and whitespace
+    is normalized. Patterns are compiled once, are matched against one line at a time and have no nested quantifiers,
+    so the whole body is cleaned in linear time.
+    """
+    SPLITTER_LINE_PATTERN = re.compile(
+        r'-+ *(?:Forwarded message|Original Message) *-+\s*$|'
+        r'On.*wrote:$|'
+        r'(?:From|Sent|To|Subject):', re.IGNORECASE)
+    # First characters a splitter line can start with, so most lines never reach the regex
+    SPLITTER_FIRST_CHARACTERS = frozenset('-OoFfSsTt')
+    WHITESPACE_RUN_PATTERN = re.compile(r'[ \t]+')
+
+    def is_quoted(self, stripped_line):
+        first_character = stripped_line[0]
+        if first_character == '>':
+            return True
+        return first_character in self.SPLITTER_FIRST_CHARACTERS and self.SPLITTER_LINE_PATTERN.match(stripped_line) is not None
+
+    def is_signature_delimiter(self, line):
+        # Matches the old "--" followed by a line break rule, which also covers the standard "-- " delimiter
+        return line.rstrip().endswith('--')
+
+    def clean(self, content, strip_quotes=True, strip_signature=True):
+        lines = []
+        pending_blank = False
+        for line in content.replace('\r\n', '\n').split('\n'):
+            stripped_line = line.lstrip()
+            if not stripped_line:
+                # Runs of blank lines collapse to a single blank line between paragraphs
+                pending_blank = bool(lines)
+                continue
+            if strip_quotes and self.is_quoted(stripped_line):
+                continue
+            signature_found = strip_signature and self.is_signature_delimiter(line)
+            if signature_found:
+                # Like the old rule, only the delimiter and what follows it are cut; "see below --" keeps "see below"
+                line = line.rstrip()[:-2]
+                if not line.strip():
+                    break
+            if '\t' in line or '  ' in line:
+                line = self.WHITESPACE_RUN_PATTERN.sub(' ', line)
+            if pending_blank:
+                lines.append('')
+                pending_blank = False
+            lines.append(line)
+            if signature_found:
+                break
+        return '\n'.join(lines).strip()
+
+
+@lru_cache(maxsize=1024)
+def parse_email_date(date_value):
+    # Strict RFC 2822 first; dateutil's fuzzy parser only for headers it rejects. Dates without a zone are read as UTC
+    # so every result can be compared with every other
+    try:
+        date = parsedate_to_datetime(date_value)
+    except (TypeError, ValueError):
+        date = parse(date_value)
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+
+def message_date(record):
+    # Gmail's internalDate (epoch milliseconds) needs no parsing at all; the Date header is the fallback
+    if record.get("internal_date"):
+        return datetime.fromtimestamp(int(record["internal_date"]) / 1000, tz=timezone.utc)
+    return parse_email_date(record["date"])
+
+
+class HtmlToText:
+    """
+    Backend interface for turning an HTML body into text. Quoted history (<blockquote>) and <style>/<script> content
+    are dropped during extraction, so the text handed to the ReplyCleaner is only the new reply.
+    """
+    name = None
+    DROPPED_TAGS = ("blockquote", "style", "script")
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def to_text(self, html_content):
+        raise NotImplementedError
+
+
+class SelectolaxHtmlToText(HtmlToText):
+    # lexbor parser in C; the dropped tags are removed from the tree before the text is read in one call
+    name = "selectolax"
+
+    @classmethod
+    def available(cls):
+        return SelectolaxParser is not None
+
+    def to_text(self, html_content):
+        tree = SelectolaxParser(html_content)
+        tree.strip_tags(list(self.DROPPED_TAGS))
+        return tree.root.text(separator="") if tree.root is not None else ""
+
+
+class LxmlTextCollector:
+    # Parser target for LxmlHtmlToText: receives parse events and keeps text outside the dropped tags, no tree is built
+    def __init__(self, dropped_tags):
+        self.dropped_tags = dropped_tags
+        self.dropped_depth = 0
+        self.parts = []
+
+    def start(self, tag, attrib):
+        if tag in self.dropped_tags:
+            self.dropped_depth += 1
+
+    def end(self, tag):
+        if tag in self.dropped_tags and self.dropped_depth:
+            self.dropped_depth -= 1
+
+    def data(self, data):
+        if not self.dropped_depth:
+            self.parts.append(data)
+
+    def close(self):
+        return "".join(self.parts)
+
+
+class LxmlHtmlToText(HtmlToText):
+    # libxml2 parser streaming events into LxmlTextCollector
+    name = "lxml"
+    CHUNK_SIZE = 64 * 1024
+
+    @classmethod
+    def available(cls):
+        return etree is not None
+
+    def to_text(self, html_content):
+        if not html_content.strip():
+            return ""
+        parser = etree.HTMLParser(target=LxmlTextCollector(frozenset(self.DROPPED_TAGS)))
+        for start in range(0, len(html_content), self.CHUNK_SIZE):
+            parser.feed(html_content[start:start + self.CHUNK_SIZE])
+        return parser.close()
+
+
+class BeautifulSoupHtmlToText(HtmlToText):
+    # Pure-Python fallback, always available
+    name = "beautifulsoup"
+
+    def to_text(self, html_content):
+        soup = BeautifulSoup(html_content, "html.parser")
+        for element in soup.find_all(self.DROPPED_TAGS):
+            element.decompose()
+        return soup.get_text()
+
+
+HTML_TO_TEXT_BACKENDS = (SelectolaxHtmlToText, LxmlHtmlToText, BeautifulSoupHtmlToText)
+
+
+def create_html_to_text(backend_name="auto"):
+    # "auto" picks the fastest installed backend; a named backend that is not installed falls back to BeautifulSoup
+    for backend in HTML_TO_TEXT_BACKENDS:
+        if backend_name in ("auto", backend.name) and backend.available():
+            return backend()
+    print(f"HTML backend {backend_name} unavailable, using beautifulsoup.")
+    return BeautifulSoupHtmlToText()
+
 
 class EmailParser:
+    html_to_text = create_html_to_text()
+
     def __init__(self, payload):
         self.payload = payload
+        self.reply_cleaner = ReplyCleaner()
         print("EmailParser initialized with payload.")
 
     def extract_details(self):
@@ -20,7 +212,7 @@ class EmailParser:
             sender = self.extract_email_address(sender_value) if sender_value else None
             recipients = [self.extract_email_address(email) for email in recipient_value.split(',')] if recipient_value else None
             subject = subject_value if subject_value else None
-            date = parse(date_value) if date_value else None
+            date = parse_email_date(date_value) if date_value else None
 
             return sender, recipients, subject, date
         except Exception as e:
@@ -34,16 +226,15 @@ class EmailParser:
             else:
                 cleaned_content = raw_content
 
-            cleaned_content = self.remove_quoted_content(cleaned_content)
-            return cleaned_content.strip()
+            # Quotes, splitters, signature and whitespace are all handled in one pass over the lines
+            return self.reply_cleaner.clean(cleaned_content)
         except Exception as e:
             print(f"Error processing email content: {e}")
             return ""
 
     def remove_html(self, html_content):
         try:
-            soup = BeautifulSoup(html_content, "html.parser")
-            return soup.get_text()
+            return self.html_to_text.to_text(html_content)
         except Exception as e:
             print(f"Error removing HTML content: {e}")
             return html_content
@@ -57,33 +248,11 @@ class EmailParser:
             raise ValueError('Unsupported content type: ' + content_type)
 
     def remove_quoted_content_plain(self, content):
-        # Define regex patterns for quoted lines and splitter patterns
-        quoted_line_pattern = re.compile(r'^\s*>+.*$', re.MULTILINE)
-        splitter_pattern = re.compile(
-            r'^\s*[-]+[ ]*Forwarded message[ ]*[-]+\s*$|'
-            r'^\s*[-]+[ ]*Original Message[ ]*[-]+\s*$|'
-            r'^\s*On.*wrote:$|'
-            r'^\s*From:.*$|'
-            r'^\s*Sent:.*$|'
-            r'^\s*To:.*$|'
-            r'^\s*Subject:.*$', re.MULTILINE | re.IGNORECASE)
-
-        # Remove quoted lines
-        content = re.sub(quoted_line_pattern, '', content)
-        # Remove splitter patterns
-        content = re.sub(splitter_pattern, '', content)
-        # Clean up the content
-        content = self.clean_up_content(content)
-        return content
+        return self.reply_cleaner.clean(content, strip_signature=False)
 
     def remove_quoted_content_html(self, content):
-        # Parse the HTML content with BeautifulSoup
-        soup = BeautifulSoup(content, 'html.parser')
-        # Remove blockquote tags and other common quoting structures
-        for blockquote in soup.find_all('blockquote'):
-            blockquote.decompose()
-        # Convert back to string and clean up the content
-        content = str(soup)
+        # Blockquotes and other quoting structures are dropped by the HTML backend while extracting the text
+        content = self.html_to_text.to_text(content)
         content = self.clean_up_content(content)
         return content
 
@@ -103,6 +272,10 @@ class EmailParser:
             print(f"Error getting header value for {header_name}: {e}")
             return None
 
+    def get_headers(self):
+        # Every header by lower-cased name, for the checks downstream that need more than From/To/Subject/Date
+        return {header["name"].lower(): header["value"] for header in self.payload.get("headers", [])}
+
     def extract_email_address(self, string):
         try:
             email_regex = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
@@ -112,31 +285,535 @@ class EmailParser:
             print(f"Error extracting email address from string: {e}")
             return ""
 
+class MessageCache:
+    """Bounded LRU of decoded message records, keyed by Gmail message id."""
+    MISSING = object()
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id):
+        # Returns MessageCache.MISSING when the id is not cached, since None is a valid (skipped) record
+        if message_id not in self.records:
+            self.misses += 1
+            return self.MISSING
+        self.hits += 1
+        self.records.move_to_end(message_id)
+        return self.records[message_id]
+
+    def __contains__(self, message_id):
+        return message_id in self.records
+
+    def put(self, message_id, record):
+        self.records[message_id] = record
+        self.records.move_to_end(message_id)
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.records)}
+
+
+class SizeBudget:
+    """
+    Byte budgets for message bodies. Each body is cut before it is decoded and parsed, so a newsletter or log dump
+    cannot stall the step, and the cleaned thread is cut newest-first so the oldest messages give way first.
+    A budget of 0 means no limit.
+    """
+    # How far back from the cut a line break (or space) is looked for before cutting mid-line
+    BOUNDARY_WINDOW = 2048
+
+    def __init__(self, max_message_bytes=0, max_thread_bytes=0):
+        self.max_message_bytes = max_message_bytes
+        self.max_thread_bytes = max_thread_bytes
+        self.counters = {"messages_truncated": 0, "message_bytes_dropped": 0, "threads_truncated": 0, "thread_bytes_dropped": 0}
+
+    def stats(self):
+        return dict(self.counters)
+
+    def decode_body(self, data, content_type, charset="utf-8"):
+        # Returns the decoded text and the number of bytes dropped; only the base64 inside the budget is decoded
+        total_bytes = len(data) * 3 // 4 - data[-2:].count("=")
+        if not self.max_message_bytes or total_bytes <= self.max_message_bytes:
+            return base64.urlsafe_b64decode(data).decode(charset, errors="replace"), 0
+        kept = base64.urlsafe_b64decode(data[:-(-self.max_message_bytes // 3) * 4])[:self.max_message_bytes]
+        # errors="ignore" only matters for the character split by the cut
+        text = self.cut_at_boundary(kept.decode(charset, errors="ignore"), content_type)
+        dropped_bytes = total_bytes - len(text.encode(charset, errors="replace"))
+        self.counters["messages_truncated"] += 1
+        self.counters["message_bytes_dropped"] += dropped_bytes
+        return text, dropped_bytes
+
+    def cut_at_boundary(self, text, content_type):
+        # Back off to the last line break (or space) near the cut, and never leave half an HTML tag behind
+        if content_type == "text/html":
+            tag_start = text.rfind("<")
+            if tag_start > text.rfind(">"):
+                text = text[:tag_start]
+        window_start = len(text) - self.BOUNDARY_WINDOW
+        for separator in ("\n", " "):
+            position = text.rfind(separator)
+            if position >= window_start:
+                return text[:position]
+        return text
+
+    def with_note(self, content, dropped_bytes, scope):
+        if not dropped_bytes:
+            return content
+        return f"{content.rstrip()}\n\n[{dropped_bytes} bytes of this message were dropped to stay within the {scope} size budget]"
+
+    def apply_to_thread(self, loaded):
+        # loaded: (message_id, label_ids, record) tuples, oldest first; cached records are copied, never modified
+        if not self.max_thread_bytes:
+            return loaded
+        remaining = self.max_thread_bytes
+        dropped_total = 0
+        budgeted = []
+        for message_id, label_ids, record in reversed(loaded):
+            if record is not None:
+                content_bytes = record["content"].encode()
+                if len(content_bytes) > remaining:
+                    content = self.cut_at_boundary(content_bytes[:remaining].decode("utf-8", errors="ignore"), "text/plain") if remaining else ""
+                    dropped_bytes = len(content_bytes) - len(content.encode())
+                    dropped_total += dropped_bytes
+                    record = {**record, "content": self.with_note(content, dropped_bytes, "thread")}
+                remaining -= min(len(content_bytes), remaining)
+            budgeted.append((message_id, label_ids, record))
+        if dropped_total:
+            self.counters["threads_truncated"] += 1
+            self.counters["thread_bytes_dropped"] += dropped_total
+        budgeted.reverse()
+        return budgeted
+
+class MessageStore:
+    """
+    On-disk store of parsed message records, keyed by Gmail message id.
+    Message content never changes once sent, so a stored record stays valid; the history id is kept alongside it
+    so the store reflects the latest state Gmail reported for the message.
+    """
+    # Bump whenever parse_message output changes so records parsed by older code are treated as misses
+    RECORD_VERSION = 5
+    _shared = None
+
+    def __init__(self, path, max_records=5000, max_age_days=14):
+        self.max_records = max_records
+        self.max_age_seconds = max_age_days * 86400
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id TEXT PRIMARY KEY, thread_id TEXT, history_id TEXT, "
+            "record_version INTEGER, record TEXT, last_used REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id)")
+        self.connection.commit()
+        print("MessageStore initialized.")
+
+    @classmethod
+    def shared(cls, store_config):
+        # One connection per warm process; it is closed and reopened only when the store settings change
+        if cls._shared is None or cls._shared.config != store_config:
+            if cls._shared is not None:
+                cls._shared.close()
+                cls._shared = None
+            message_store = cls(store_config["path"], store_config["max_records"], store_config["max_age_days"])
+            message_store.config = store_config
+            cls._shared = message_store
+        return cls._shared
+
+    def close(self):
+        self.connection.close()
+
+    def has_thread(self, thread_id):
+        row = self.connection.execute(
+            "SELECT 1 FROM messages WHERE record_version = ? AND thread_id = ? LIMIT 1", (self.RECORD_VERSION, thread_id)
+        ).fetchone()
+        return row is not None
+
+    def get_many(self, message_ids):
+        if not message_ids:
+            return {}
+        placeholders = ",".join("?" for _ in message_ids)
+        rows = self.connection.execute(
+            f"SELECT message_id, record FROM messages WHERE record_version = ? AND message_id IN ({placeholders})",
+            [self.RECORD_VERSION, *message_ids]
+        ).fetchall()
+        return {message_id: json.loads(record) for message_id, record in rows}
+
+    def put_many(self, thread_id, entries):
+        # entries: (message_id, history_id, record) tuples; a None record marks a message with no usable content
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+            [(message_id, thread_id, history_id, self.RECORD_VERSION, json.dumps(record), now) for message_id, history_id, record in entries]
+        )
+        self.evict()
+        self.connection.commit()
+
+    def touch_many(self, entries):
+        # entries: (message_id, history_id) tuples for records that were served from the store
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE messages SET history_id = ?, last_used = ? WHERE message_id = ?",
+            [(history_id, now, message_id) for message_id, history_id in entries]
+        )
+        self.connection.commit()
+
+    def evict(self):
+        self.connection.execute("DELETE FROM messages WHERE last_used < ?", (time.time() - self.max_age_seconds,))
+        self.connection.execute(
+            "DELETE FROM messages WHERE message_id IN "
+            "(SELECT message_id FROM messages ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_records,)
+        )
+
+class HttpTransport:
+    """
+    Keep-alive HTTP sessions, one pooled session per host, shared by every call a step makes. The instance lives at
+    module level so warm invocations keep their open connections. Counters cover the current run only (see start_run).
+    Pipedream steps cannot import each other, so steps 2-5 carry copies of this class; change them together.
+    """
+    _shared = None
+
+    def __init__(self, transport_config):
+        self.config = transport_config
+        self.timeout = (transport_config["connect_timeout"], transport_config["read_timeout"])
+        self.sessions = {}
+        self.connections_seen = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, transport_config):
+        if cls._shared is None or cls._shared.config != transport_config:
+            cls._shared = cls(transport_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {}
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config["pool_size"])
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        session = self.session(host)
+        response = session.request(method, url, **kwargs)
+        pools = session.get_adapter(url).poolmanager.pools
+        with self.lock:
+            # urllib3 bumps num_connections only when a pool has to open a new socket
+            connections = sum(pools[key].num_connections for key in pools.keys())
+            opened = connections - self.connections_seen.get(host, 0)
+            self.connections_seen[host] = connections
+        self.count(host, opened)
+        return response
+
+    def count(self, host, connections_opened):
+        with self.lock:
+            counters = self.counters.setdefault(host, {"requests": 0, "connections_opened": 0})
+            counters["requests"] += 1
+            counters["connections_opened"] += connections_opened
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {**counters, "connections_reused": counters["requests"] - counters["connections_opened"]}
+                for host, counters in self.counters.items()
+            }
+
+
+class GmailRateLimiter:
+    """
+    Token bucket over Gmail quota units with retries for throttled and failed calls. Each call waits until its quota
+    cost is available, and 429s, rateLimitExceeded 403s and 5xx responses to reads back off exponentially with full
+    jitter. A send or modify that got a 5xx may have gone through, so only throttled writes are resent.
+    The bucket is per process: every client in this step draws from it, but each step, and each concurrent workflow
+    execution, runs in its own process with its own bucket. It smooths one step's bursts; Gmail's 429s and
+    Retry-After remain the only mailbox-wide limit. Steps 2 and 4 carry copies of this class; change them together.
+    """
+    # Quota units of the calls this step makes, from the Gmail API usage limits table
+    QUOTA_UNITS = {
+        "messages.get": 5,
+        "threads.get": 10,
+    }
+    DEFAULT_QUOTA_UNITS = 10
+    RATE_LIMIT_STATUS_CODES = {429}
+    SERVER_ERROR_STATUS_CODES = {500, 502, 503, 504}
+    RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+    _shared = None
+
+    def __init__(self, gmail_client_config):
+        self.config = gmail_client_config
+        self.rate = gmail_client_config["quota_units_per_second"]
+        self.capacity = gmail_client_config["quota_units_per_second"]
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.start_run()
+
+    @classmethod
+    def shared(cls, gmail_client_config):
+        if cls._shared is None or cls._shared.config != gmail_client_config:
+            cls._shared = cls(gmail_client_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {"quota_units": 0, "throttled_seconds": 0.0, "retries": 0}
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "throttled_seconds": round(self.counters["throttled_seconds"], 3)}
+
+    @staticmethod
+    def operation(method, path):
+        # "threads/<id>/modify" -> threads.modify, "messages/<id>" -> messages.get, "drafts" -> drafts.create
+        segments = path.split("?")[0].split("/")
+        if method == "GET":
+            return f"{segments[0]}.get" if len(segments) > 1 else f"{segments[0]}.list"
+        return f"{segments[0]}.create" if len(segments) == 1 else f"{segments[0]}.{segments[-1]}"
+
+    def acquire(self, units):
+        # Blocks the calling worker thread until the bucket holds enough quota for this call. A call that costs more
+        # than the whole bucket (messages.send under a quota below 100 units per second) waits for a full bucket
+        units = min(units, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= units:
+                    self.available -= units
+                    return
+                wait = (units - self.available) / self.rate
+            self.count("throttled_seconds", wait)
+            time.sleep(wait)
+
+    def should_retry(self, method, response):
+        if response.status_code in self.RATE_LIMIT_STATUS_CODES:
+            return True
+        if response.status_code in self.SERVER_ERROR_STATUS_CODES:
+            # A 502 or 504 on messages/send or drafts does not mean the call failed; resending could mail twice
+            return method == "GET"
+        return response.status_code == 403 and any(reason in response.text for reason in self.RATE_LIMIT_REASONS)
+
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.config["backoff_max_seconds"])
+        ceiling = min(self.config["backoff_max_seconds"], self.config["backoff_base_seconds"] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call(self, method, path, send):
+        units = self.QUOTA_UNITS.get(self.operation(method, path), self.DEFAULT_QUOTA_UNITS)
+        for attempt in range(self.config["max_retries"] + 1):
+            self.acquire(units)
+            self.count("quota_units", units)
+            final_attempt = attempt == self.config["max_retries"]
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Only reads are safe to resend after a dropped connection; a send or modify may have gone through
+                if method != "GET" or final_attempt:
+                    raise
+                print(f"Gmail {method} {path} failed ({e}), retrying.")
+                response = None
+            else:
+                if final_attempt or not self.should_retry(method, response):
+                    return response
+                print(f"Gmail {method} {path} returned {response.status_code}, retrying.")
+            self.count("retries", 1)
+            time.sleep(self.backoff_delay(attempt, response))
+
+
+class AsyncGmailClient:
+    """
+    Gmail REST client shared by the workflow steps. Requests run on worker threads under asyncio so independent
+    calls can be in flight together, capped at max_concurrency, and go out over the pooled HttpTransport sessions with
+    quota throttling and retries from GmailRateLimiter. Callers get the same requests.Response objects as before.
+    """
+    BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+    def __init__(self, headers, transport, rate_limiter, max_concurrency=8):
+        self.headers = headers
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._semaphore = None
+
+    def semaphore(self):
+        # asyncio primitives belong to one event loop, so rebuild the cap for each loop we run on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method, path, **kwargs):
+        url = f"{self.BASE_URL}/{path}"
+        async with self.semaphore():
+            return await asyncio.to_thread(
+                self.rate_limiter.call, method, path, lambda: self.transport.request(method, url, headers=self.headers, **kwargs)
+            )
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    def run_all(self, coroutines):
+        # Run independent requests concurrently and return their responses in order. The requests themselves run on
+        # worker threads over the pooled sessions, so nothing is lost with the short-lived loop
+        async def gather():
+            return await asyncio.gather(*coroutines)
+        return asyncio.run(gather())
+
+    def run(self, coroutine):
+        return self.run_all([coroutine])[0]
+
 class GmailAPI:
-    def __init__(self, headers):
+    CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+    def __init__(self, headers, transport, rate_limiter, cache_size=256, message_store=None, max_incremental_fetches=3, max_concurrency=8, size_budget=None):
         self.headers = headers
+        self.size_budget = size_budget or SizeBudget()
+        self.gmail_client = AsyncGmailClient(headers, transport, rate_limiter, max_concurrency)
+        self.message_cache = MessageCache(cache_size)
+        self.message_store = message_store
+        self.max_incremental_fetches = max_incremental_fetches
         print("GmailAPI initialized with headers.")
 
-    def get_thread_messages(self, thread_id):
+    def get_thread(self, thread_id, format="full"):
         try:
-            url = f"https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}"
-            response = requests.get(url, headers=self.headers)
+            response = self.gmail_client.run(self.gmail_client.get(f"threads/{thread_id}", params={"format": format}))
             response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-            messages = response.json().get("messages", [])
-            return [(message["id"], message.get("labelIds", [])) for message in messages]
+            return response.json().get("messages", [])
         except requests.HTTPError as e:
-            print(f"HTTPError while getting thread messages: {e}")
+            print(f"HTTPError while getting thread: {e}")
             raise
         except Exception as e:
-            print(f"Error while getting thread messages: {e}")
+            print(f"Error while getting thread: {e}")
             raise
 
+    def get_thread_messages(self, thread_id):
+        # Only ids and labels are needed here, so skip the payloads entirely
+        messages = self.get_thread(thread_id, format="minimal")
+        return [(message["id"], message.get("labelIds", [])) for message in messages]
+
+    def load_thread(self, thread_id):
+        if self.message_store is None:
+            return self.load_full_thread(thread_id)
+
+        try:
+            thread_stored = self.message_store.has_thread(thread_id)
+            if thread_stored:
+                # List the thread without payloads and only fetch the messages the store has not seen yet
+                listing = self.get_thread(thread_id, format="minimal")
+                stored = self.message_store.get_many([message["id"] for message in listing])
+        except sqlite3.Error as e:
+            # Locked or corrupt database, or a full /tmp: the store is only a shortcut
+            print(f"Message store unavailable, parsing full thread: {e}")
+            return self.load_full_thread(thread_id)
+
+        if not thread_stored:
+            # A listing would only be followed by the full fetch, so fetch the thread once; its messages carry the
+            # ids, labels and history ids the listing would have
+            print("Message store has no messages of this thread. Loading full thread.")
+            listing = self.get_thread(thread_id, format="full")
+            stored = {}
+            loaded = self.parse_thread(listing)
+        else:
+            missing = [message for message in listing if message["id"] not in stored]
+            if not stored or len(missing) > self.max_incremental_fetches:
+                # Too many new messages: one full-thread fetch is cheaper than a GET per message
+                print(f"Message store has {len(stored)} of {len(listing)} messages. Loading full thread.")
+                loaded = self.load_full_thread(thread_id, skip_parsing=stored)
+            else:
+                print(f"Message store has {len(stored)} of {len(listing)} messages. Fetching {len(missing)} new message(s).")
+                for message_id, record in stored.items():
+                    self.message_cache.put(message_id, record)
+                records = self.get_many_message_data([message["id"] for message in listing])
+                loaded = [(message["id"], message.get("labelIds", []), record) for message, record in zip(listing, records)]
+
+        history_ids = {message["id"]: message.get("historyId") for message in listing}
+        try:
+            self.message_store.put_many(thread_id, [(message_id, history_ids.get(message_id), record) for message_id, _, record in loaded if message_id not in stored])
+            self.message_store.touch_many([(message_id, history_ids.get(message_id)) for message_id in stored])
+        except sqlite3.Error as e:
+            print(f"Message store not updated: {e}")
+        return loaded
+
+    def load_full_thread(self, thread_id, skip_parsing=None):
+        # threads.get with format=full already carries every message payload, so the
+        # whole thread is parsed from a single response instead of one GET per message
+        for message_id, record in (skip_parsing or {}).items():
+            self.message_cache.put(message_id, record)
+        return self.parse_thread(self.get_thread(thread_id, format="full"))
+
+    def parse_thread(self, messages):
+        return [(message["id"], message.get("labelIds", []), self.get_parsed_message(message)) for message in messages]
+
+    def get_parsed_message(self, message):
+        # Parse a message resource we already hold, reusing the cached record when there is one
+        record = self.message_cache.get(message["id"])
+        if record is MessageCache.MISSING:
+            record = self.parse_message(message)
+            self.message_cache.put(message["id"], record)
+        return record
+
     def get_message_data(self, message_id):
+        record = self.message_cache.get(message_id)
+        if record is not MessageCache.MISSING:
+            return record
         try:
-            url = f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{message_id}"
-            response = requests.get(url, headers=self.headers)
+            response = self.gmail_client.run(self.gmail_client.get(f"messages/{message_id}"))
             response.raise_for_status()
-            message = response.json()
+            record = self.parse_message(response.json())
+            self.message_cache.put(message_id, record)
+            return record
+        except requests.HTTPError as e:
+            print(f"HTTPError while getting message data: {e}")
+            raise
+        except Exception as e:
+            print(f"Error while getting message data: {e}")
+            raise
+
+    def get_many_message_data(self, message_ids):
+        # Fetch every message that is not cached yet concurrently, then answer from the cache in the original order
+        missing = [message_id for message_id in dict.fromkeys(message_ids) if message_id not in self.message_cache]
+        try:
+            responses = self.gmail_client.run_all([self.gmail_client.get(f"messages/{message_id}") for message_id in missing])
+            for message_id, response in zip(missing, responses):
+                response.raise_for_status()
+                self.message_cache.put(message_id, self.parse_message(response.json()))
+        except requests.HTTPError as e:
+            print(f"HTTPError while getting message data: {e}")
+            raise
+        except Exception as e:
+            print(f"Error while getting message data: {e}")
+            raise
+        return [self.get_message_data(message_id) for message_id in message_ids]
+
+    def parse_message(self, message):
+        try:
+            message_id = message.get('id')
             message_payload = message.get('payload', {})
             content_type = message_payload.get('mimeType', '')
 
@@ -146,15 +823,14 @@ class GmailAPI:
                 return None
 
             raw_content = None
-            if 'parts' in message_payload:
-                for part in message_payload['parts']:
-                    if part['mimeType'] in ['text/plain', 'text/html']:
-                        content_type = part['mimeType']
-                        raw_content = base64.urlsafe_b64decode(part['body']['data']).decode("utf-8")
-                        break
-            elif 'mimeType' in message_payload and 'body' in message_payload and 'data' in message_payload['body']:
-                content_type = message_payload.get('mimeType', 'text/plain')
-                raw_content = base64.urlsafe_b64decode(message_payload['body']['data']).decode("utf-8")
+            dropped_bytes = 0
+            text_part = self.select_text_part(message_payload)
+            if text_part is not None:
+                # Only the chosen part is ever decoded
+                content_type = text_part['mimeType']
+                raw_content, dropped_bytes = self.size_budget.decode_body(
+                    text_part['body']['data'], content_type, self.get_part_charset(text_part)
+                )
 
             if raw_content is None:
                 print(f"No content found for message ID {message_id}. Skipping.")
@@ -162,21 +838,63 @@ class GmailAPI:
 
             email_parser = EmailParser({'headers': message_payload.get('headers', [])})
             processed_content = email_parser.process_content(content_type, raw_content)
+            processed_content = self.size_budget.with_note(processed_content, dropped_bytes, "message")
 
             return {
                 'sender': email_parser.extract_email_address(email_parser.get_header_value('From')),
                 'recipients': [email_parser.extract_email_address(addr) for addr in email_parser.get_header_value('To').split(',')],
                 'subject': email_parser.get_header_value('Subject'),
                 'date': email_parser.get_header_value('Date'),
+                'internal_date': message.get('internalDate'),
                 'content': processed_content
             }
-        except requests.HTTPError as e:
-            print(f"HTTPError while getting message data: {e}")
-            raise
         except Exception as e:
-            print(f"Error while getting message data: {e}")
+            print(f"Error while parsing message data: {e}")
             raise
 
+    def iter_text_parts(self, part):
+        # Depth-first and lazy: nested multiparts (alternative inside mixed, related inside alternative) are walked
+        # only as far as the caller asks, and attachment bodies are never touched
+        mime_type = part.get('mimeType', '')
+        if mime_type.startswith('multipart/'):
+            for child in part.get('parts', []):
+                yield from self.iter_text_parts(child)
+        elif mime_type in ('text/plain', 'text/html') and 'data' in part.get('body', {}) and not self.is_attachment(part):
+            yield part
+
+    def is_attachment(self, part):
+        if part.get('filename'):
+            return True
+        disposition = self.get_part_header(part, 'Content-Disposition') or ''
+        return disposition.lower().startswith('attachment')
+
+    def select_text_part(self, payload):
+        # Stop at the first text/plain part; the first text/html part is only kept as the fallback
+        html_part = None
+        for part in self.iter_text_parts(payload):
+            if part['mimeType'] == 'text/plain':
+                return part
+            if html_part is None:
+                html_part = part
+        return html_part
+
+    def get_part_header(self, part, header_name):
+        for header in part.get('headers', []):
+            if header['name'].lower() == header_name.lower():
+                return header['value']
+        return None
+
+    def get_part_charset(self, part):
+        content_type = self.get_part_header(part, 'Content-Type') or ''
+        match = self.CHARSET_PATTERN.search(content_type)
+        if match is None:
+            return 'utf-8'
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            print(f"Unknown charset {match.group(1)}, decoding as utf-8.")
+            return 'utf-8'
+
     def format_email_information(self, sender, recipient, subject, date, content):
         try:
             formatted_content = f"From: {sender}\nTo: {recipient}\nSubject: {subject}\nDate: {date}\n\n{content}"
@@ -191,31 +909,29 @@ class GmailAPI:
         all_subjects = set()
         contents = []
 
+        # Decode each message once; sorting and processing below both read from the same record
+        records = self.get_many_message_data([message_id for message_id, _ in messages])
+        # Skip messages without usable content (DSNs, empty bodies)
+        records = [record for record in records if record is not None]
+
         # Sort messages by date
-        messages.sort(key=lambda msg: parse(self.get_message_data(msg[0])["date"]), reverse=True)
+        records.sort(key=message_date, reverse=True)
 
         most_recent_sender = None
-        for idx, message_data in enumerate(messages):
-            message_id, message_labels = message_data
-            message_information = self.get_message_data(message_id)
-            if message_information is None:
-                continue  # Skip this message and continue with the next one
+        for idx, message_information in enumerate(records):
             sender = message_information["sender"]
             recipients = message_information["recipients"]
             subject = message_information["subject"]
             all_senders.add(sender)
             all_recipients.update(recipients)
             all_subjects.add(subject)
-            cleaned_content = message_information["content"]
-            content_processor = ContentProcessor(cleaned_content)
-            cleaned_content = content_processor.remove_signatures()
-            cleaned_content = content_processor.normalize_content()
+            # Content was already cleaned in one pass by EmailParser.process_content
             formatted_message = self.format_email_information(
                 sender,
                 recipients,
                 subject,
                 message_information["date"],
-                cleaned_content
+                message_information["content"]
             )
             contents.append(formatted_message)
 
@@ -237,21 +953,53 @@ class GmailAPI:
 class ContentProcessor:
     def __init__(self, content):
         self.content = content
+        self.reply_cleaner = ReplyCleaner()
         print("ContentProcessor initialized with content.")
 
+    def clean_reply(self):
+        # Quotes, signature and whitespace in a single pass (see ReplyCleaner)
+        self.content = self.reply_cleaner.clean(self.content)
+        return self.content
+
     def remove_signatures(self):
         # Assuming signatures are separated by "--" or similar markers
-        signature_pattern = re.compile(r'(--\s*\n.*$)', re.MULTILINE | re.DOTALL)
-        self.content, _ = re.subn(signature_pattern, '', self.content)
+        self.content = self.reply_cleaner.clean(self.content, strip_quotes=False)
         return self.content
 
     def normalize_content(self):
         # Normalize whitespace and line breaks
-        self.content = re.sub(r'\r\n', '\n', self.content)  # Normalize line breaks
-        self.content = re.sub(r'[ \t]+', ' ', self.content)  # Normalize spaces
-        self.content = re.sub(r'\n{3,}', '\n\n', self.content)  # Normalize multiple line breaks
+        self.content = self.reply_cleaner.clean(self.content, strip_quotes=False, strip_signature=False)
+        return self.content
+
+    def remove_repeated_paragraphs(self, shingle_index, source):
+        # Paragraphs whose word shingles mostly appeared in an earlier message of the thread become a short
+        # back-reference; a run of repeated paragraphs collapses into one reference. source names this message in
+        # later references (ThreadMessage.source); None keeps it from being referenced at all
+        paragraphs = []
+        repeated_sources = []
+        for paragraph in self.content.split("\n\n"):
+            repeated_source = shingle_index.find_source(paragraph)
+            if repeated_source is not None:
+                if repeated_source not in repeated_sources:
+                    repeated_sources.append(repeated_source)
+                continue
+            if repeated_sources:
+                paragraphs.append(self.format_back_reference(repeated_sources))
+                repeated_sources = []
+            paragraphs.append(paragraph)
+        if repeated_sources:
+            paragraphs.append(self.format_back_reference(repeated_sources))
+        if source is not None:
+            shingle_index.add(self.content, source)
+        self.content = "\n\n".join(paragraphs)
         return self.content
 
+    def format_back_reference(self, sources):
+        # Messages are named by sender and date, which the rendered headers show, rather than by position
+        if len(sources) == 1:
+            return f"[repeats the message {sources[0]} above]"
+        return f"[repeats the messages {'; '.join(sources)} above]"
+
     def extract_reply_body(self):
         # Use the EmailParser's method to remove quoted content
         # Since ContentProcessor does not handle headers, we should not attempt to extract headers here
@@ -262,13 +1010,267 @@ class ContentProcessor:
         return self.content
 
 
+class ThreadMessage:
+    """
+    One message of the exported thread. Steps hand these to each other as compact positional lists (dump_all and
+    load_all) instead of pre-formatted strings, and the prompt text is only rendered where it is used.
+    """
+    __slots__ = ("message_id", "sender", "recipients", "subject", "date", "body")
+
+    def __init__(self, message_id, sender, recipients, subject, date, body):
+        self.message_id = message_id
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+        self.date = date
+        self.body = body
+
+    def with_body(self, body):
+        return ThreadMessage(self.message_id, self.sender, self.recipients, self.subject, self.date, body)
+
+    def header_lines(self):
+        return [f"From: {self.sender}", f"To: {self.recipients}", f"Subject: {self.subject}", f"Date: {self.date}"]
+
+    def source(self):
+        # How back-references name this message, from the sender and date its rendered header shows
+        return f"from {self.sender} on {self.date}"
+
+    def render(self):
+        return "\n".join(self.header_lines()) + f"\n\n{self.body}"
+
+    @staticmethod
+    def render_all(messages, summary=None):
+        # Prompt text for a list of messages, after the rolling summary of older messages when there is one
+        rendered = [f"Summary of the earlier messages in this thread:\n{summary}"] if summary else []
+        return rendered + [message.render() for message in messages]
+
+    @staticmethod
+    def dump_all(messages):
+        # One list per message in __slots__ order, so the step export carries no repeated keys
+        return [[getattr(message, field) for field in ThreadMessage.__slots__] for message in messages]
+
+    @staticmethod
+    def load_all(rows):
+        return [ThreadMessage(*row) for row in rows]
+
+
+class ShingleIndex:
+    """
+    Word shingles seen so far in a thread, with the message each first appeared in. Shingle hashes are computed with a
+    rolling polynomial hash, one multiply-add per word, so indexing and lookups stay linear in the thread's length.
+    """
+    WORD_PATTERN = re.compile(r"\w+")
+    SHINGLE_WORDS = 8
+    # Share of a paragraph's shingles that must already be known for it to count as a repeat
+    REPEAT_THRESHOLD = 0.8
+    BASE = 1000003
+    MODULUS = (1 << 61) - 1
+
+    def __init__(self):
+        self.first_seen = {}
+        self.top_power = pow(self.BASE, self.SHINGLE_WORDS - 1, self.MODULUS)
+        self.paragraphs_replaced = 0
+
+    def shingles(self, text):
+        word_hashes = [hash(word) % self.MODULUS for word in self.WORD_PATTERN.findall(text.lower())]
+        value = 0
+        for index, word_hash in enumerate(word_hashes):
+            if index >= self.SHINGLE_WORDS:
+                value = (value - word_hashes[index - self.SHINGLE_WORDS] * self.top_power) % self.MODULUS
+            value = (value * self.BASE + word_hash) % self.MODULUS
+            if index >= self.SHINGLE_WORDS - 1:
+                yield value
+
+    def find_source(self, paragraph):
+        # Returns the source of the earlier message a paragraph repeats, or None; paragraphs shorter than one
+        # shingle ("Thanks,", "Best regards") are never treated as repeats
+        shingles = list(self.shingles(paragraph))
+        sources = [self.first_seen[shingle] for shingle in shingles if shingle in self.first_seen]
+        if not shingles or len(sources) < self.REPEAT_THRESHOLD * len(shingles):
+            return None
+        self.paragraphs_replaced += 1
+        return max(set(sources), key=sources.count)
+
+    def add(self, text, source):
+        for shingle in self.shingles(text):
+            self.first_seen.setdefault(shingle, source)
+
+
+# Loaded once per process and shared by every ThreadCompactor; the routers in step 2 count with the same encoding
+TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+
+
+class ThreadCompactor:
+    """
+    Fits the thread into a token budget before it is exported to the routers and the drafter. Paragraphs an older
+    message already contains (history pasted without ">" markers) become back-references in the newer copies. The
+    newest messages are never shortened; older messages are shortened and then dropped until the thread fits.
+    A max_tokens of 0 means no limit.
+    """
+    # An older message is dropped rather than shortened to fewer tokens than this
+    MIN_SHORTENED_TOKENS = 50
+    SHORTENED_NOTE = " [...shortened to fit the token budget]"
+
+    def __init__(self, max_tokens=0, keep_recent_messages=3):
+        self.max_tokens = max_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.counters = {
+            "tokens_before": 0,
+            "tokens_after": 0,
+            "tokens_saved": 0,
+            "duplicate_paragraphs_removed": 0,
+            "messages_shortened": 0,
+            "messages_dropped": 0
+        }
+
+    def stats(self):
+        return dict(self.counters)
+
+    def count_tokens(self, text):
+        return len(TOKEN_ENCODING.encode(text))
+
+    def compact(self, messages):
+        # messages: ThreadMessage records, oldest first
+        tokens_before = sum(self.count_tokens(message.render()) for message in messages)
+        kept = messages
+        first_shortened = False
+        while True:
+            deduplicated, paragraphs_replaced = self.remove_repeated_paragraphs(kept, first_shortened)
+            compacted, token_counts, shortened = self.fit(deduplicated)
+            if len(compacted) == len(kept) and bool(shortened) == first_shortened:
+                break
+            # Back-references into a dropped message, or into the cut-off end of a shortened one, would point at
+            # nothing, so the kept messages are deduplicated again with only the whole ones as sources. That only
+            # lengthens the newer messages, so the oldest kept one never grows back and the loop ends
+            kept = kept[len(kept) - len(compacted):]
+            first_shortened = bool(shortened)
+        self.counters["tokens_before"] += tokens_before
+        self.counters["tokens_after"] += sum(token_counts)
+        self.counters["tokens_saved"] += tokens_before - sum(token_counts)
+        self.counters["duplicate_paragraphs_removed"] += paragraphs_replaced
+        self.counters["messages_shortened"] += shortened
+        self.counters["messages_dropped"] += len(messages) - len(compacted)
+        return compacted
+
+    def remove_repeated_paragraphs(self, messages, first_shortened=False):
+        # messages: oldest first. With first_shortened the oldest one is not sent whole and is never referenced
+        shingle_index = ShingleIndex()
+        deduplicated = [
+            message.with_body(ContentProcessor(message.body).remove_repeated_paragraphs(
+                shingle_index, None if first_shortened and index == 0 else message.source()
+            ))
+            for index, message in enumerate(messages)
+        ]
+        return deduplicated, shingle_index.paragraphs_replaced
+
+    def fit(self, messages):
+        # Returns the kept messages, oldest first, their token counts and how many of them were shortened. The counts
+        # are those of the messages as rendered, markers included, and stay within max_tokens unless the newest
+        # messages alone exceed it
+        token_counts = [self.count_tokens(message.render()) for message in messages]
+        if not self.max_tokens or sum(token_counts) <= self.max_tokens:
+            return messages, token_counts, 0
+
+        recent_start = max(len(messages) - self.keep_recent_messages, 0)
+        # Room for the omitted-messages marker is set aside before the older messages are fitted. Tokens can merge
+        # across the marker's edges, so the thread is measured again with the marker in place and refitted with
+        # less room while it is still over the budget
+        reserved = self.count_tokens(self.omitted_marker(recent_start))
+        while True:
+            compacted, compacted_counts, shortened_messages = self.fit_older_messages(
+                messages, token_counts, recent_start, self.max_tokens - reserved
+            )
+            dropped = len(messages) - len(compacted)
+            # The marker goes into the oldest kept message so the list still holds one entry per kept message
+            if dropped:
+                compacted[0] = compacted[0].with_body(f"{self.omitted_marker(dropped)}{compacted[0].body}")
+                compacted_counts[0] = self.count_tokens(compacted[0].render())
+            excess = sum(compacted_counts) - self.max_tokens
+            if excess <= 0 or len(compacted) <= len(messages) - recent_start:
+                return compacted, compacted_counts, shortened_messages
+            reserved += excess
+
+    def fit_older_messages(self, messages, token_counts, recent_start, budget):
+        # Keeps the newest messages whole and as many older ones as fit in what is left of budget, newest first; the
+        # first older message that does not fit is shortened, or dropped with everything older
+        remaining = budget - sum(token_counts[recent_start:])
+        compacted = []
+        compacted_counts = []
+        shortened_messages = 0
+        for index in range(recent_start - 1, -1, -1):
+            if token_counts[index] <= remaining:
+                compacted.append(messages[index])
+                compacted_counts.append(token_counts[index])
+                remaining -= token_counts[index]
+                continue
+            shortened_message = self.shorten(messages[index], token_counts[index], remaining)
+            if shortened_message is not None:
+                compacted.append(shortened_message)
+                compacted_counts.append(self.count_tokens(shortened_message.render()))
+                shortened_messages += 1
+            break
+        compacted.reverse()
+        compacted_counts.reverse()
+        compacted.extend(messages[recent_start:])
+        compacted_counts.extend(token_counts[recent_start:])
+        return compacted, compacted_counts, shortened_messages
+
+    def shorten(self, message, token_count, budget):
+        # Cuts the body so the rendered message, header and shortened note included, fits in budget tokens; None
+        # when that leaves less than MIN_SHORTENED_TOKENS of the body
+        body_tokens = TOKEN_ENCODING.encode(message.body)
+        # The header is kept whole, so only what is left after it and the note goes to the body
+        body_budget = budget - (token_count - len(body_tokens)) - self.count_tokens(self.SHORTENED_NOTE)
+        while body_budget >= self.MIN_SHORTENED_TOKENS:
+            shortened_message = message.with_body(f"{TOKEN_ENCODING.decode(body_tokens[:body_budget])}{self.SHORTENED_NOTE}")
+            shortened_count = self.count_tokens(shortened_message.render())
+            if shortened_count <= budget:
+                return shortened_message
+            # A cut inside a multi-byte character, or tokens merging across the note, can cost a few tokens more
+            body_budget -= shortened_count - budget
+        return None
+
+    @staticmethod
+    def omitted_marker(dropped):
+        return f"[{dropped} older message(s) omitted to fit the token budget]\n\n"
+
+
+def create_message_store(store_config):
+    # Returns the GmailAPI keyword arguments for the configured store. A store that cannot be opened here, or read
+    # in GmailAPI.load_thread, falls back to a full parse
+    if not store_config["enabled"]:
+        return {}
+    try:
+        message_store = MessageStore.shared(store_config)
+        return {"message_store": message_store, "max_incremental_fetches": store_config["max_incremental_fetches"]}
+    except sqlite3.Error as e:
+        print(f"Message store unavailable, parsing full thread: {e}")
+        return {}
+
+
 def handler(pd: "pipedream"):
     try:
         # Step 1: Instantiate Classes
         token = f'{pd.inputs["gmail_custom_oauth"]["$auth"]["oauth_access_token"]}'
         authorization = f'Bearer {token}'
         headers = {"Authorization": authorization}
-        gmail_api = GmailAPI(headers)
+        parse_thread_config = pd.steps["workflow_config"]["parse_thread_config"]
+        gmail_client_config = pd.steps["workflow_config"]["gmail_client_config"]
+        EmailParser.html_to_text = create_html_to_text(parse_thread_config["html_to_text_backend"])
+        http_transport = HttpTransport.shared(pd.steps["workflow_config"]["http_transport_config"])
+        http_transport.start_run()
+        rate_limiter = GmailRateLimiter.shared(gmail_client_config)
+        rate_limiter.start_run()
+        size_budget = SizeBudget(**parse_thread_config["size_budget"])
+        thread_compactor = ThreadCompactor(**parse_thread_config["compaction"])
+        gmail_api = GmailAPI(
+            headers,
+            http_transport,
+            rate_limiter,
+            max_concurrency=gmail_client_config["max_concurrency"],
+            size_budget=size_budget,
+            **create_message_store(parse_thread_config["message_store"])
+        )
 
         # Step 2: Extract Email Details
         message_id = pd.steps["trigger"]["event"]["id"]
@@ -281,24 +1283,20 @@ def handler(pd: "pipedream"):
             print("One or more essential details are missing from the email. Skipping this message.")
             return  # Skip to the next message
 
-        # Step 3: Fetch Thread Messages
-        messages = gmail_api.get_thread_messages(thread_id)
+        # Step 3: Fetch Thread Messages (payloads included, one request for the whole thread)
+        messages = size_budget.apply_to_thread(gmail_api.load_thread(thread_id))
 
         # Step 4: Process Each Message
-        contents = []
-        for message_data in messages:
-            message_id, _ = message_data
-            message_info = gmail_api.get_message_data(message_id)
+        thread_messages = []
+        for thread_message_id, _, message_info in messages:
             if message_info is None:
                 continue  # Skip this message and continue with the next one
-            content_processor = ContentProcessor(message_info["content"])
-            processed_content = content_processor.remove_signatures()
-            processed_content = content_processor.normalize_content()
-            reply_body = content_processor.extract_reply_body()
-            formatted_message = gmail_api.format_email_information(
-                sender, recipients, subject, date, reply_body
-            )
-            contents.append(formatted_message)
+            # Each record carries its own message's headers; content was already cleaned by EmailParser.process_content
+            thread_messages.append(ThreadMessage(
+                thread_message_id, message_info["sender"], message_info["recipients"], message_info["subject"],
+                str(message_info["date"]), message_info["content"]
+            ))
+        thread_messages = thread_compactor.compact(thread_messages)
 
         # Step 5: Compile Results
         most_recent_sender = sender if sender else recipients[0]
@@ -310,7 +1308,14 @@ def handler(pd: "pipedream"):
         pd.export("sender", sender)
         pd.export("recipient", recipients[0] if recipients else None)
         pd.export("subject", subject)
-        pd.export("contents", contents)
+        pd.export("headers", email_parser.get_headers())
+        pd.export("mime_type", payload.get("mimeType", ""))
+        pd.export("thread_messages", ThreadMessage.dump_all(thread_messages))
+        pd.export("http_transport_stats", http_transport.stats())
+        pd.export("gmail_rate_limiter_stats", rate_limiter.stats())
+        pd.export("message_cache_stats", gmail_api.message_cache.stats())
+        pd.export("size_budget_stats", size_budget.stats())
+        pd.export("compaction_stats", thread_compactor.stats())
 
     except KeyError as error:
         print(f"An error occurred: {error}")
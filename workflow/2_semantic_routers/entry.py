@@ -2,7 +2,25 @@
 from simpleaichat import AsyncAIChat, AIChat
 from pydantic import BaseModel, Field
 import asyncio
+import hashlib
+from collections import OrderedDict
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
 import tiktoken
+# NumPy is optional: without it the nearest-neighbor router stays off
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# packages for pooled HTTP connections
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 # packages for interacting with Gmail API for edge case handling 
 import requests
 import base64
@@ -62,113 +80,1133 @@ class EmailScenario(BaseModel):
     inquiry_type: str = Field(description="Type of inquiry. Can include: Organizationanic inbound, cold email outbound reply, warm intro reply.")
     sender_category: str = Field(description="Category of sender. Can include: ICP 1: Silent Giant, ICP 2: High Growth Innovation, Other ICP Type.", default=None)
 
+# Fused router: every decision above from one structured-output call (semantic_routers_config["router_mode"] = "fused")
+
+class EmailRouting(EmailClassification, EmailRelevancy, EmailSensitivity, EmailSentimentAndFunnelStage, EmailScenario):
+    """
+    This class represents every routing decision for an email at once: whether it requires a response, whether it is
+    relevant, whether it is sensitive, its sentiment and funnel stage, and its scenario.
+    """
+
+
+# Loaded once per process and shared by every TokenCounter
+TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+
 
 class TokenCounter:
-    def __init__(self, pd):
+    """
+    Per-run token ledger on the module-level encoder. Counts are memoized by content hash across runs, so a thread
+    read by several calls is tokenized once. Every counted call lands in the ledger, exported once as "token_ledger".
+    """
+    MAX_CACHED_COUNTS = 512
+    _counts = OrderedDict()
+    _counts_lock = threading.Lock()
+
+    def __init__(self, pd, http_transport=None):
         self.pd = pd
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.http_transport = http_transport
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.wasted_tokens = 0
+        self.saved_tokens = {}
 
     def count_tokens(self, text):
-        return len(self.encoding.encode(text))
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self._counts_lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        count = len(TOKEN_ENCODING.encode(text))
+        with self._counts_lock:
+            self._counts[key] = count
+            if len(self._counts) > self.MAX_CACHED_COUNTS:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_and_record(self, input_text, output_result, name):
+        # Adds one model call to the ledger and returns its input + output tokens
+        input_tokens = self.count_tokens(input_text)
+        output_tokens = self.count_tokens(str(output_result))
+        with self.lock:
+            entry = self.calls.setdefault(name, {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0})
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["total_tokens"] += input_tokens + output_tokens
+        return input_tokens + output_tokens
+
+    def record_wasted(self, tokens):
+        # Tokens billed for answers nobody reads
+        with self.lock:
+            self.wasted_tokens += tokens
+
+    def record_saved(self, source, tokens):
+        # Tokens a call would have cost had its answer not been reused from source
+        with self.lock:
+            self.saved_tokens[source] = self.saved_tokens.get(source, 0) + tokens
+
+    def ledger(self):
+        with self.lock:
+            spent_tokens = sum(entry["total_tokens"] for entry in self.calls.values())
+            return {
+                "calls": {name: dict(entry) for name, entry in self.calls.items()},
+                "spent_tokens": spent_tokens,
+                "wasted_tokens": self.wasted_tokens,
+                "total_tokens": spent_tokens + self.wasted_tokens,
+                "saved_tokens": dict(self.saved_tokens),
+                # What the API reported, prompt-cache hits included
+                "provider_usage": self.http_transport.llm_usage() if self.http_transport else {},
+            }
+
+
+class ThreadMessage:
+    """
+    One message of the exported thread. Steps hand these to each other as compact positional lists (dump_all and
+    load_all) instead of pre-formatted strings, and the prompt text is only rendered where it is used.
+    """
+    __slots__ = ("message_id", "sender", "recipients", "subject", "date", "body")
+
+    def __init__(self, message_id, sender, recipients, subject, date, body):
+        self.message_id = message_id
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+        self.date = date
+        self.body = body
+
+    def with_body(self, body):
+        return ThreadMessage(self.message_id, self.sender, self.recipients, self.subject, self.date, body)
+
+    def header_lines(self):
+        return [f"From: {self.sender}", f"To: {self.recipients}", f"Subject: {self.subject}", f"Date: {self.date}"]
+
+    def source(self):
+        # How back-references name this message, from the sender and date its rendered header shows
+        return f"from {self.sender} on {self.date}"
+
+    def render(self):
+        return "\n".join(self.header_lines()) + f"\n\n{self.body}"
+
+    @staticmethod
+    def render_all(messages, summary=None):
+        # Prompt text for a list of messages, after the rolling summary of older messages when there is one
+        rendered = [f"Summary of the earlier messages in this thread:\n{summary}"] if summary else []
+        return rendered + [message.render() for message in messages]
+
+    @staticmethod
+    def dump_all(messages):
+        # One list per message in __slots__ order, so the step export carries no repeated keys
+        return [[getattr(message, field) for field in ThreadMessage.__slots__] for message in messages]
+
+    @staticmethod
+    def load_all(rows):
+        return [ThreadMessage(*row) for row in rows]
+
+
+class ThreadSummaryStore:
+    """
+    On-disk rolling summary per thread, tied to the id of the last message it covers, so a new reply only needs
+    the messages that came after it.
+    """
+    _shared = None
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS thread_summaries ("
+            "thread_id TEXT PRIMARY KEY, summary TEXT, last_message_id TEXT, updated_at REAL)"
+        )
+        self.connection.commit()
+        print("ThreadSummaryStore initialized.")
+
+    @classmethod
+    def shared(cls, path):
+        # One connection per warm process; it is closed and reopened only when the store moves
+        if cls._shared is None or cls._shared.path != path:
+            if cls._shared is not None:
+                cls._shared.close()
+                cls._shared = None
+            cls._shared = cls(path)
+        return cls._shared
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, thread_id):
+        # Returns (summary, last_message_id), or None when the thread has no summary yet
+        return self.connection.execute(
+            "SELECT summary, last_message_id FROM thread_summaries WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+
+    def put(self, thread_id, summary, last_message_id):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO thread_summaries VALUES (?, ?, ?, ?)",
+            (thread_id, summary, last_message_id, time.time())
+        )
+        self.connection.commit()
+
+
+class ThreadSummarizer:
+    """
+    Sends "summary + new messages" instead of the whole thread. The newest messages always go out word for word;
+    the summary of everything older is only regenerated once more than max_uncovered_messages older messages have
+    arrived since it was written, and then from the previous summary plus those messages only.
+    """
+    # parse_thread's back-references to repeated paragraphs, "[repeats the message from <sender> on <date> above]"
+    BACK_REFERENCE_PATTERN = re.compile(r"\[repeats the messages? (from .*?) above\]")
+
+    def __init__(self, ai, summary_store, summary_config):
+        self.ai = ai
+        self.summary_store = summary_store
+        self.recent_messages = summary_config["recent_messages"]
+        self.max_uncovered_messages = summary_config["max_uncovered_messages"]
+        self.prompt = summary_config["prompt"]
+        self.counters = {"summary_reused": 0, "summary_regenerated": 0, "messages_summarized": 0, "messages_sent_in_full": 0}
+
+    def stats(self):
+        return dict(self.counters)
+
+    def build_context(self, thread_id, messages):
+        # messages: ThreadMessage records, oldest first. Returns the summary to send (or None), the messages to send
+        # in full and, when a new summary was generated, the (input, summary) pair of that call for token counting.
+        recent_start = max(len(messages) - self.recent_messages, 0)
+        if recent_start == 0:
+            self.counters["messages_sent_in_full"] = len(messages)
+            return None, messages, None
+
+        previous_summary = None
+        uncovered = messages[:recent_start]
+        message_ids = [message.message_id for message in messages]
+        stored = self.summary_store.get(thread_id)
+        if stored is not None and stored[1] in message_ids[:recent_start]:
+            covered = message_ids.index(stored[1]) + 1
+            if recent_start - covered <= self.max_uncovered_messages:
+                # Close enough: the few older messages the summary does not cover yet are sent in full
+                self.counters["summary_reused"] = 1
+                self.counters["messages_sent_in_full"] = len(messages) - covered
+                return stored[0], self.resolve_back_references(messages[covered:]), None
+            previous_summary, uncovered = stored[0], messages[covered:recent_start]
+
+        summary_input = self.build_summary_input(previous_summary, uncovered)
+        summary = self.ai(summary_input, system=self.prompt, save_messages=False)
+        self.summary_store.put(thread_id, summary, message_ids[recent_start - 1])
+        self.counters["summary_regenerated"] = 1
+        self.counters["messages_summarized"] = len(uncovered)
+        self.counters["messages_sent_in_full"] = len(messages) - recent_start
+        return summary, self.resolve_back_references(messages[recent_start:]), (summary_input, summary)
+
+    def build_summary_input(self, previous_summary, messages):
+        summary_input = f"Summary so far:\n{previous_summary}\n\n" if previous_summary else ""
+        messages = self.resolve_back_references(messages)
+        return summary_input + "Messages to add to the summary:\n\n" + "\n\n---\n\n".join(ThreadMessage.render_all(messages))
+
+    def resolve_back_references(self, messages):
+        # A back-reference into a message that now only lives in the summary would point at text that is not sent,
+        # so it points at the summary instead
+        shown = {message.source() for message in messages}
+
+        def resolve(match):
+            sources = match.group(1).split("; ")
+            kept = [source for source in sources if source in shown]
+            if len(kept) == len(sources):
+                return match.group(0)
+            if not kept:
+                return "[repeats earlier messages covered by the summary above]"
+            return f"[repeats the messages {'; '.join(kept)} above, and earlier messages covered by the summary]"
+
+        return [message.with_body(self.BACK_REFERENCE_PATTERN.sub(resolve, message.body)) for message in messages]
+
+
+def create_thread_summary_store(summary_config):
+    # Without a store every router gets the full thread, as before
+    if not summary_config["enabled"]:
+        return None
+    try:
+        return ThreadSummaryStore.shared(summary_config["path"])
+    except sqlite3.Error as e:
+        print(f"Thread summary store unavailable, sending full thread: {e}")
+        return None
+
+
+class RouterResultCache:
+    """
+    Router answers keyed by a hash of (router prompt, model, schema, normalized input), so a reprocessed thread or a
+    repeated notification template gets its decisions back without a model call. Results older than ttl_hours are
+    asked again; past max_records the least recently used are evicted.
+    """
+    WHITESPACE_PATTERN = re.compile(r"\s+")
+    _shared = None
+
+    def __init__(self, path, max_records=5000, ttl_hours=72):
+        self.max_records = max_records
+        self.ttl_seconds = ttl_hours * 3600
+        # The speculative router reads and writes from its event loop thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS router_results ("
+            "cache_key TEXT PRIMARY KEY, result TEXT, created_at REAL, last_used REAL)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.start_run()
+        print("RouterResultCache initialized.")
 
-    def count_and_export_tokens(self, input_text, output_result, export_name):
-        # Count tokens in the input and output
-        input_token_count = self.count_tokens(input_text)
-        output_token_count = self.count_tokens(str(output_result))
-        total_tokens = input_token_count + output_token_count
+    @classmethod
+    def shared(cls, cache_config):
+        # One connection per warm process; it is closed and reopened only when the cache settings change
+        if cls._shared is None or cls._shared.config != cache_config:
+            if cls._shared is not None:
+                cls._shared.close()
+                cls._shared = None
+            router_cache = cls(cache_config["path"], cache_config["max_records"], cache_config["ttl_hours"])
+            router_cache.config = cache_config
+            cls._shared = router_cache
+        return cls._shared
 
-        # Export the total token count
-        self.pd.export(export_name, total_tokens)
+    def start_run(self):
+        with self.lock:
+            self.counters = {"hits": 0, "misses": 0, "tokens_saved": 0}
 
-        # Return the total token count
-        return total_tokens
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def key(self, system_prompt, model, schema, input_data):
+        # Whitespace-only differences (re-wrapped text, trailing blank lines) map to the same entry
+        normalized_input = self.WHITESPACE_PATTERN.sub(" ", input_data).strip()
+        return hashlib.sha256(json.dumps([system_prompt, model, schema.__name__, normalized_input]).encode()).hexdigest()
+
+    def get(self, cache_key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT result FROM router_results WHERE cache_key = ? AND created_at >= ?",
+                (cache_key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            self.connection.execute("UPDATE router_results SET last_used = ? WHERE cache_key = ?", (now, cache_key))
+            self.connection.commit()
+            return json.loads(row[0])
+
+    def put(self, cache_key, result):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO router_results VALUES (?, ?, ?, ?)", (cache_key, json.dumps(result), now, now)
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM router_results WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.connection.execute(
+            "DELETE FROM router_results WHERE cache_key IN "
+            "(SELECT cache_key FROM router_results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_records,)
+        )
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class HeaderPrefilter:
+    """
+    Rule-based check of the trigger message's headers, run before the thread summary and every router call. Each
+    matching rule adds its weight from prefilter_config["rules"]; at min_score the message is bulk or automated mail
+    and is labelled NOT_FROM_REAL_PERSON with no model call. The instance lives at module level so hit rates add up
+    across warm invocations.
+    """
+    _shared = None
+
+    def __init__(self, prefilter_config):
+        self.config = prefilter_config
+        self.rules = prefilter_config["rules"]
+        self.counters = {"messages_checked": 0, "messages_labelled": 0, "rule_hits": {rule: 0 for rule in self.rules}}
+        self.last_check = {}
+
+    @classmethod
+    def shared(cls, prefilter_config):
+        if cls._shared is None or cls._shared.config != prefilter_config:
+            cls._shared = cls(prefilter_config)
+        return cls._shared
+
+    def is_noreply(self, sender):
+        # "no-reply", "no_reply" and "NoReply" all compact to "noreply"
+        local_part = re.sub(r"[^a-z0-9]", "", (sender or "").split("@")[0].lower())
+        return any(name in local_part for name in self.config["noreply_senders"])
+
+    def is_esp_return_path(self, return_path):
+        domain = return_path.strip().strip("<>").rpartition("@")[2].lower()
+        return bool(domain) and any(domain == esp or domain.endswith("." + esp) for esp in self.config["esp_return_path_domains"])
+
+    def matched_rules(self, headers, sender, mime_type):
+        checks = {
+            "list_unsubscribe": "list-unsubscribe" in headers,
+            "precedence_bulk": headers.get("precedence", "").strip().lower() in self.config["precedence_values"],
+            # RFC 3834: anything but "no" marks an automatic message, out-of-office replies included
+            "auto_submitted": headers.get("auto-submitted", "no").strip().lower() not in ("", "no"),
+            "noreply_sender": self.is_noreply(sender),
+            "esp_return_path": self.is_esp_return_path(headers.get("return-path", "")),
+            "dsn_mime_type": (mime_type or "").lower() in self.config["dsn_mime_types"],
+        }
+        return [rule for rule, matched in checks.items() if matched and self.rules.get(rule, 0)]
+
+    def check(self, headers, sender, mime_type):
+        # Returns True when the message should be labelled without asking the model
+        if not self.config["enabled"]:
+            return False
+        matched = self.matched_rules(headers, sender, mime_type)
+        score = sum(self.rules[rule] for rule in matched)
+        labelled = score >= self.config["min_score"]
+        self.counters["messages_checked"] += 1
+        self.counters["messages_labelled"] += labelled
+        for rule in matched:
+            self.counters["rule_hits"][rule] += 1
+        self.last_check = {"matched_rules": matched, "score": score, "labelled": labelled}
+        return labelled
+
+    def stats(self):
+        checked = self.counters["messages_checked"]
+        return {
+            **self.last_check,
+            "messages_checked": checked,
+            "messages_labelled": self.counters["messages_labelled"],
+            "hit_rate": round(self.counters["messages_labelled"] / checked, 3) if checked else 0.0,
+            "rule_hits": dict(self.counters["rule_hits"]),
+        }
+
+
+def create_router_cache(cache_config):
+    # Without a cache every router decision goes to the model, as before
+    if not cache_config["enabled"]:
+        return None
+    try:
+        router_cache = RouterResultCache.shared(cache_config)
+    except sqlite3.Error as e:
+        print(f"Router result cache unavailable, asking the model every time: {e}")
+        return None
+    router_cache.start_run()
+    return router_cache
+
+
+class NearestNeighborIndex:
+    """
+    Local similarity index over past input_data and the router answers given for it. Texts become hashed char
+    n-gram vectors weighted by TF-IDF, so no embedding service is involved. When the most similar past email clears
+    similarity_threshold, its answers are reused instead of calling the model; audit_rate of those reuses still go to
+    the model so agreement can be measured. Held at module level and saved to an .npz file after each run.
+    """
+    _shared = None
+    NGRAM_SIZES = (3, 4, 5)
+    WHITESPACE_PATTERN = re.compile(r"\s+")
+
+    def __init__(self, index_config):
+        self.config = index_config
+        self.path = index_config["path"]
+        self.dimensions = index_config["dimensions"]
+        self.lock = threading.Lock()
+        self.load()
+        self.start_run()
+
+    @classmethod
+    def shared(cls, index_config):
+        if cls._shared is None or cls._shared.config != index_config:
+            cls._shared = cls(index_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.query_text = None
+            self.neighbor = None
+            self.answers = {}
+            self.changed = False
+            self.counters = {"lookups": 0, "reused": 0, "tokens_saved": 0, "audited": 0, "agreed": 0}
+
+    def load(self):
+        self.vectors = np.zeros((0, self.dimensions), dtype=np.float32)
+        self.keys, self.results, self.used_at = [], [], np.zeros(0)
+        self.audit_totals = [0, 0]  # audited, agreed, over the life of the index file
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if data["vectors"].shape[1] != self.dimensions:
+                    raise ValueError("dimensions changed")
+                self.vectors = data["vectors"].astype(np.float32)
+                self.keys, self.results = data["keys"].tolist(), data["results"].tolist()
+                self.used_at = data["used_at"]
+                self.audit_totals = data["audit_totals"].tolist()
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Neighbor index at {self.path} unreadable, starting empty: {e}")
+        print(f"NearestNeighborIndex loaded with {len(self.keys)} emails.")
+
+    def save(self):
+        # Written to a temporary file first so a failed write never leaves a truncated index behind. Uncompressed,
+        # with half-precision vectors: compressing a full index takes longer than the routing it saves
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as index_file:
+                np.savez(
+                    index_file, vectors=self.vectors.astype(np.float16), keys=np.array(self.keys, dtype=str),
+                    results=np.array(self.results, dtype=str), used_at=self.used_at, audit_totals=np.array(self.audit_totals)
+                )
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Neighbor index not saved: {e}")
+
+    def normalize(self, text):
+        return self.WHITESPACE_PATTERN.sub(" ", text.lower()).strip()
+
+    def vectorize(self, text):
+        # Byte n-grams hashed into a fixed number of buckets, with sublinear term frequency
+        data = np.frombuffer(self.normalize(text).encode(), dtype=np.uint8).astype(np.uint64)
+        counts = np.zeros(self.dimensions, dtype=np.float32)
+        for size in self.NGRAM_SIZES:
+            if len(data) < size:
+                continue
+            hashes = np.zeros(len(data) - size + 1, dtype=np.uint64)
+            for offset in range(size):
+                hashes = hashes * np.uint64(1099511628211) + data[offset:len(data) - size + 1 + offset]
+            hashes ^= hashes >> np.uint64(31)
+            counts += np.bincount((hashes % np.uint64(self.dimensions)).astype(np.int64), minlength=self.dimensions)
+        return np.log1p(counts)
+
+    def nearest(self, query_vector):
+        # Returns (row, cosine similarity) of the closest stored email under TF-IDF weighting, or None when empty
+        if not self.keys:
+            return None
+        document_frequency = np.count_nonzero(self.vectors, axis=0)
+        inverse_document_frequency = np.log((1 + len(self.keys)) / (1 + document_frequency)) + 1
+        weighted = self.vectors * inverse_document_frequency
+        weighted_query = query_vector * inverse_document_frequency
+        norms = np.linalg.norm(weighted, axis=1) * np.linalg.norm(weighted_query)
+        similarities = weighted @ weighted_query / np.maximum(norms, 1e-12)
+        row = int(np.argmax(similarities))
+        return row, float(similarities[row])
+
+    def fingerprint(self, system_prompt):
+        # Answers given under a different prompt are never reused
+        return hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+
+    def lookup(self, input_data, system_prompt, schema):
+        with self.lock:
+            if self.query_text != input_data:
+                self.query_text = input_data
+                self.query_vector = self.vectorize(input_data)
+                self.neighbor = self.nearest(self.query_vector)
+            self.counters["lookups"] += 1
+            if self.neighbor is None or schema.__name__ not in self.config["reuse_schemas"]:
+                return None
+            row, similarity = self.neighbor
+            if similarity < self.config["similarity_threshold"]:
+                return None
+            stored = json.loads(self.results[row]).get(schema.__name__)
+            if stored is None or stored["prompt"] != self.fingerprint(system_prompt):
+                return None
+            self.used_at[row] = time.time()
+            return stored["result"]
+
+    def audit_due(self):
+        return random.random() < self.config["audit_rate"]
+
+    def reuse(self, tokens_saved):
+        with self.lock:
+            self.counters["reused"] += 1
+            self.counters["tokens_saved"] += tokens_saved
+
+    def remember(self, system_prompt, schema, result, neighbor_result=None):
+        # Keeps a model answer for this run's email; neighbor_result is the answer that was audited against it
+        with self.lock:
+            self.answers[schema.__name__] = {"prompt": self.fingerprint(system_prompt), "result": result}
+            if neighbor_result is not None:
+                agreed = neighbor_result == result
+                self.counters["audited"] += 1
+                self.counters["agreed"] += agreed
+                self.audit_totals = [self.audit_totals[0] + 1, self.audit_totals[1] + agreed]
+
+    def save_run(self):
+        # Inserts this run's model answers (merged into the row of an identical earlier email) and saves the index
+        with self.lock:
+            if not self.answers or self.query_text is None:
+                return
+            key = hashlib.sha256(self.normalize(self.query_text).encode()).hexdigest()
+            if key in self.keys:
+                row = self.keys.index(key)
+                self.results[row] = json.dumps({**json.loads(self.results[row]), **self.answers})
+                self.used_at[row] = time.time()
+            else:
+                self.vectors = np.vstack([self.vectors, self.query_vector[np.newaxis, :]])
+                self.keys.append(key)
+                self.results.append(json.dumps(self.answers))
+                self.used_at = np.append(self.used_at, time.time())
+            self.evict()
+            self.save()
+            self.answers = {}
+
+    def evict(self):
+        if len(self.keys) <= self.config["max_records"]:
+            return
+        keep = np.sort(np.argsort(self.used_at)[-self.config["max_records"]:])
+        self.vectors = self.vectors[keep]
+        self.keys = [self.keys[row] for row in keep]
+        self.results = [self.results[row] for row in keep]
+        self.used_at = self.used_at[keep]
+
+    def stats(self):
+        with self.lock:
+            audited, agreed = self.audit_totals
+            return {
+                **self.counters,
+                "emails_indexed": len(self.keys),
+                "nearest_similarity": round(self.neighbor[1], 4) if self.neighbor else None,
+                "agreement_rate": round(agreed / audited, 3) if audited else None,
+                "audited_total": audited,
+            }
+
+
+def create_neighbor_index(index_config):
+    # Without an index every router decision goes to the model (or the exact-match cache), as before
+    if not index_config["enabled"]:
+        return None
+    if np is None:
+        print("NumPy not installed, nearest-neighbor router off.")
+        return None
+    neighbor_index = NearestNeighborIndex.shared(index_config)
+    neighbor_index.start_run()
+    return neighbor_index
 
 
 class EmailHandler:
-    def __init__(self, pd, config, assembled_prompts):
+    def __init__(self, pd, config, assembled_prompts, http_transport, router_cache=None, neighbor_index=None):
         self.pd = pd
+        self.http_transport = http_transport
+        self.router_cache = router_cache
+        self.neighbor_index = neighbor_index
         self.config = config
         self.assembled_prompts = assembled_prompts
-        self.token_counter = TokenCounter(pd)
+        self.token_counter = TokenCounter(pd, http_transport)
         self.token = f'{pd.inputs["openai"]["$auth"]["api_key"]}'
         self.authorization = f'Bearer {self.token}'
         self.headers = {"Authorization": self.authorization}
-        self.ai_sync = AIChat(api_key=self.token, console=False, model="gpt-4-0125-preview", headers=self.headers, temperature=0.0)
-        self.ai_async = AsyncAIChat(api_key=self.token, console=False, model="gpt-4-0125-preview", headers=self.headers, temperature=0.0)
+        self.model = "gpt-4-0125-preview"
+        api_url = http_transport.config["llm_api_url"]
+        self.ai_sync = AIChat(api_key=self.token, api_url=api_url, console=False, model=self.model, headers=self.headers, temperature=0.0)
+        self.ai_async = AsyncAIChat(api_key=self.token, api_url=api_url, console=False, model=self.model, headers=self.headers, temperature=0.0)
+        self.ai_sync.client = http_transport.llm_client()
         self.sender = pd.steps["parse_thread"]["sender"]
         self.recipient = pd.steps["parse_thread"]["recipient"]
         self.subject = pd.steps["parse_thread"]["subject"]
-        self.content = pd.steps["parse_thread"]["contents"]
-        self.input_data = f"Sender: {self.sender}. Recipient: {self.recipient}. Subject: {self.subject}. Content: {self.content}."
+        self.thread_messages = ThreadMessage.load_all(pd.steps["parse_thread"]["thread_messages"])
+        self.thread_summary = None
+        self.content = ThreadMessage.render_all(self.thread_messages)
+        self.input_data = self.build_input_data()
+        self.thread_summary_stats = {}
+
+    def build_input_data(self):
+        # Thread first, oldest message first: a later run on the same thread repeats it as a prefix and can hit the
+        # provider's prompt cache. The fields of the triggering message change from reply to reply, so they go last
+        return f"Content: {self.content}. Sender: {self.sender}. Recipient: {self.recipient}. Subject: {self.subject}."
+
+    def apply_thread_summary(self, summary_store):
+        # Older messages are replaced by the stored rolling summary before any router sees the thread
+        if summary_store is None:
+            return
+        summarizer = ThreadSummarizer(self.ai_sync, summary_store, self.config["thread_summary"])
+        self.thread_summary, self.thread_messages, summary_call = summarizer.build_context(
+            self.pd.steps["trigger"]["event"]["threadId"], self.thread_messages
+        )
+        self.content = ThreadMessage.render_all(self.thread_messages, self.thread_summary)
+        self.input_data = self.build_input_data()
+        self.thread_summary_stats = summarizer.stats()
+        if summary_call is not None:
+            summary_input, summary = summary_call
+            self.token_counter.count_and_record(summary_input, summary, "thread_summary")
+
+    def cached_result(self, system_prompt, schema):
+        # Returns (cache key, cached result); the key is None when no cache is configured
+        if self.router_cache is None:
+            return None, None
+        cache_key = self.router_cache.key(system_prompt, self.model, schema, self.input_data)
+        result = self.router_cache.get(cache_key)
+        if result is not None:
+            print(f"{schema.__name__} served from the router cache.")
+            tokens_saved = self.token_counter.count_tokens(self.input_data) + self.token_counter.count_tokens(str(result))
+            self.router_cache.count("tokens_saved", tokens_saved)
+            self.token_counter.record_saved("router_cache", tokens_saved)
+        return cache_key, result
+
+    def reused_result(self, system_prompt, schema):
+        # Exact cache first, then the nearest past email. Returns (result, pending): with pending None the result is
+        # final; otherwise the model has to be asked and pending carries what record_result needs afterwards
+        cache_key, result = self.cached_result(system_prompt, schema)
+        if result is not None:
+            return result, None
+        neighbor_result = None
+        if self.neighbor_index is not None:
+            neighbor_result = self.neighbor_index.lookup(self.input_data, system_prompt, schema)
+            if neighbor_result is not None and not self.neighbor_index.audit_due():
+                print(f"{schema.__name__} reused from the nearest past email.")
+                tokens_saved = self.token_counter.count_tokens(self.input_data) + self.token_counter.count_tokens(str(neighbor_result))
+                self.neighbor_index.reuse(tokens_saved)
+                self.token_counter.record_saved("neighbor_index", tokens_saved)
+                return neighbor_result, None
+        return None, (cache_key, neighbor_result)
+
+    def record_result(self, system_prompt, schema, result, pending):
+        cache_key, neighbor_result = pending
+        if cache_key is not None:
+            self.router_cache.put(cache_key, result)
+        if self.neighbor_index is not None:
+            self.neighbor_index.remember(system_prompt, schema, result, neighbor_result)
+        return result
+
+    def ask(self, system_prompt, schema):
+        # Returns (result, model_called); answers from the cache or the neighbor index cost no tokens
+        result, pending = self.reused_result(system_prompt, schema)
+        if pending is None:
+            return result, False
+        result = self.ai_sync(self.input_data, system=system_prompt, output_schema=schema)
+        return self.record_result(system_prompt, schema, result, pending), True
+
+    async def ask_async(self, system_prompt, schema, **kwargs):
+        result, pending = self.reused_result(system_prompt, schema)
+        if pending is None:
+            return result, False
+        result = await self.ai_async(self.input_data, system=system_prompt, output_schema=schema, **kwargs)
+        return self.record_result(system_prompt, schema, result, pending), True
+
+    def finish_run(self):
+        # Adds this run's model answers to the nearest-neighbor index; returns its stats for export
+        if self.neighbor_index is None:
+            return {}
+        self.neighbor_index.save_run()
+        return self.neighbor_index.stats()
 
     def classify_email(self):
         print("Classifying email...")
-        result = self.ai_sync(self.input_data, system=self.assembled_prompts["email_classification"], output_schema=EmailClassification)
+        result, model_called = self.ask(self.assembled_prompts["email_classification"], EmailClassification)
         print(f"Email classified. Result: {result}")
-        self.token_counter.count_and_export_tokens(self.input_data, str(result), "classify_email_tokens")
-        return result
+        return result, model_called
 
 
     def check_relevancy(self):
         print("Checking relevancy...")
-        result = self.ai_sync(self.input_data, system=self.assembled_prompts["email_relevancy"], output_schema=EmailRelevancy)
+        result, model_called = self.ask(self.assembled_prompts["email_relevancy"], EmailRelevancy)
         print(f"Email Relevancy Result: {result}")
-        self.token_counter.count_and_export_tokens(self.input_data, str(result), "check_relevancy_tokens")
-        return result 
+        return result, model_called
     
     def check_sensitivity(self, classification_result, relevancy_result):
         # Generate the sensitivity prompt
         system_prompt_sensitivity = self.assembled_prompts["email_sensitivity"]
         print("Checking sensitivity...")
-        self.sensitivity_result = self.ai_sync(
-            self.input_data, system=system_prompt_sensitivity, output_schema=EmailSensitivity
-        )
+        self.sensitivity_result, model_called = self.ask(system_prompt_sensitivity, EmailSensitivity)
         print(f"Email Sensitivity Result: {self.sensitivity_result}")
-        self.token_counter.count_and_export_tokens(
-            self.input_data, str(self.sensitivity_result), "check_sensitivity_tokens"
-        )
-        return self.sensitivity_result
+        return self.sensitivity_result, model_called
 
     def classify_sentiment_and_funnel_stage(self):
         # Now use the prompt to classify the sentiment and funnel stage
-        result = self.ai_sync(self.input_data, system=self.assembled_prompts["email_sentiment_and_funnel_stage"], output_schema=EmailSentimentAndFunnelStage)
+        result, model_called = self.ask(self.assembled_prompts["email_sentiment_and_funnel_stage"], EmailSentimentAndFunnelStage)
         print(f"Sentiment and funnel stage classified. Result: {result}")
-        self.token_counter.count_and_export_tokens(self.input_data, str(result), "classify_sentiment_and_funnel_stage_tokens")
-        return result
+        return result, model_called
+
+    def route_fused(self):
+        print("Routing email in a single call...")
+        result, model_called = self.ask(self.assembled_prompts["email_routing"], EmailRouting)
+        print(f"Email routed. Result: {result}")
+        return result, model_called
 
     def apply_label(self, label_category, label_name, thread_id):
-        # Access the specific category from the email_labels configuration
-        category_labels = self.config["email_labels"].get(label_category, {})
-        
-        # Fetch the label ID using the label name. Since label_id is directly the string we need, no further .get("id") is required.
-        label_id = category_labels.get(label_name.upper())  # Removed the erroneous .get("id")
-        
-        if label_id:
-            apply_label_instance = ApplyLabel(self.pd, [label_id])
+        self.apply_labels([(label_category, label_name)], thread_id)
+
+    def apply_labels(self, labels, thread_id):
+        # labels: (label_category, label_name) pairs. All of them go onto the thread in one modify call.
+        label_ids = []
+        for label_category, label_name in labels:
+            # Access the specific category from the email_labels configuration
+            category_labels = self.config["email_labels"].get(label_category, {})
+
+            # Fetch the label ID using the label name. Since label_id is directly the string we need, no further .get("id") is required.
+            label_id = category_labels.get(label_name.upper())  # Removed the erroneous .get("id")
+
+            if label_id:
+                label_ids.append(label_id)
+            else:
+                print(f"Label ID for {label_name} in category {label_category} not found. Skipping label application.")
+
+        if label_ids:
+            apply_label_instance = ApplyLabel(self.pd, label_ids)
             apply_label_instance.apply_labels(thread_id)
-        else:            
-            print(f"Label ID for {label_name} in category {label_category} not found. Skipping label application.")
 
     def handle_async_tasks(self):
         # Lazy initialization of the scenario prompt
         system_prompt_scenario = self.assembled_prompts["email_scenario"]
         system_prompt_sentiment_and_funnel_stage = self.assembled_prompts["email_sentiment_and_funnel_stage"]
-        async def async_function():
-            tasks = [
-                self.ai_async(self.input_data, system=system_prompt_scenario, output_schema=EmailScenario),
-                self.ai_async(self.input_data, system=system_prompt_sentiment_and_funnel_stage, output_schema=EmailSentimentAndFunnelStage)
-            ]
-            results = await asyncio.gather(*tasks)
+        # [(scenario result, model_called), (sentiment and funnel stage result, model_called)]
+        self.ai_async.client = self.http_transport.llm_async_client()
+        return AsyncRuntime.shared().run_all([
+            self.ask_async(system_prompt_scenario, EmailScenario),
+            self.ask_async(system_prompt_sentiment_and_funnel_stage, EmailSentimentAndFunnelStage)
+        ])
+
+
+class CountingHTTPTransport(httpx.HTTPTransport):
+    # simpleaichat sends timeout=None with every request, so the configured timeouts are enforced here instead
+    def __init__(self, http_transport, timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.http_transport = http_transport
+        self.timeout = timeout
+
+    def handle_request(self, request):
+        opened = []
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(event_name)
+
+        request.extensions["timeout"] = self.timeout.as_dict()
+        request.extensions["trace"] = trace
+        response = super().handle_request(request)
+        self.http_transport.count(request.url.host, len(opened))
+        return response
+
+
+class CountingAsyncHTTPTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, http_transport, timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.http_transport = http_transport
+        self.timeout = timeout
 
-            # Count and export tokens for each task
-            for i, result in enumerate(results):
-                self.token_counter.count_and_export_tokens(self.input_data, str(result), f"handle_async_tasks_tokens_{i}")
+    async def handle_async_request(self, request):
+        opened = []
 
-            return results
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(event_name)
+
+        request.extensions["timeout"] = self.timeout.as_dict()
+        request.extensions["trace"] = trace
+        response = await super().handle_async_request(request)
+        self.http_transport.count(request.url.host, len(opened))
+        return response
+
+
+class HttpTransport:
+    # Copy of HttpTransport in workflow/1_parse_thread/entry.py, plus the keep-alive httpx clients for OpenAI
+    _shared = None
+
+    def __init__(self, transport_config):
+        self.config = transport_config
+        self.timeout = (transport_config["connect_timeout"], transport_config["read_timeout"])
+        self.sessions = {}
+        self._llm_client = None
+        self.llm_calls = []
+        self._llm_async_client = None
+        self.connections_seen = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, transport_config):
+        if cls._shared is None or cls._shared.config != transport_config:
+            cls._shared = cls(transport_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {}
+            self.llm_calls = []
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config["pool_size"])
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def llm_timeout(self):
+        return httpx.Timeout(self.config["llm_read_timeout"], connect=self.config["connect_timeout"])
+
+    def llm_limits(self):
+        return httpx.Limits(max_connections=self.config["pool_size"], max_keepalive_connections=self.config["pool_size"])
+
+    def llm_client(self):
+        # One keep-alive client for every synchronous OpenAI call
+        with self.lock:
+            if self._llm_client is None:
+                self._llm_client = httpx.Client(
+                    transport=CountingHTTPTransport(self, self.llm_timeout(), limits=self.llm_limits()),
+                    event_hooks={"response": [self.on_llm_response]}
+                )
+            return self._llm_client
+
+    def llm_async_client(self):
+        # One keep-alive client for every async OpenAI call. httpx async pools belong to the loop that opened them,
+        # so it is only ever used on the AsyncRuntime loop
+        with self.lock:
+            if self._llm_async_client is None:
+                self._llm_async_client = httpx.AsyncClient(
+                    transport=CountingAsyncHTTPTransport(self, self.llm_timeout(), limits=self.llm_limits()),
+                    event_hooks={"response": [self.on_llm_response_async]}
+                )
+            return self._llm_async_client
+
+    def record_llm_usage(self, response):
+        # Usage block of an OpenAI-compatible response. cached_tokens is the part of the prompt the provider served
+        # from its prefix cache; it stays 0 for models or providers without prompt caching
+        try:
+            usage = response.json().get("usage") or {}
+        except ValueError:
+            return
+        if not usage:
+            return
+        with self.lock:
+            self.llm_calls.append({
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                "completion_tokens": usage.get("completion_tokens", 0),
+                "seconds": round(response.elapsed.total_seconds(), 3),
+            })
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(async_function())
+    def on_llm_response(self, response):
+        response.read()
+        self.record_llm_usage(response)
+
+    async def on_llm_response_async(self, response):
+        await response.aread()
+        self.record_llm_usage(response)
+
+    def llm_usage(self):
+        with self.lock:
+            calls = [dict(call) for call in self.llm_calls]
+        prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+        cached_tokens = sum(call["cached_tokens"] for call in calls)
+        return {
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": sum(call["completion_tokens"] for call in calls),
+            "cached_share": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+        }
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        session = self.session(host)
+        response = session.request(method, url, **kwargs)
+        pools = session.get_adapter(url).poolmanager.pools
+        with self.lock:
+            # urllib3 bumps num_connections only when a pool has to open a new socket
+            connections = sum(pools[key].num_connections for key in pools.keys())
+            opened = connections - self.connections_seen.get(host, 0)
+            self.connections_seen[host] = connections
+        self.count(host, opened)
+        return response
+
+    def count(self, host, connections_opened):
+        with self.lock:
+            counters = self.counters.setdefault(host, {"requests": 0, "connections_opened": 0})
+            counters["requests"] += 1
+            counters["connections_opened"] += connections_opened
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {**counters, "connections_reused": counters["requests"] - counters["connections_opened"]}
+                for host, counters in self.counters.items()
+            }
+
+
+class GmailRateLimiter:
+    # Copy of GmailRateLimiter in workflow/1_parse_thread/entry.py, with the quota units of this step's calls
+    QUOTA_UNITS = {
+        "threads.get": 10,
+        "threads.modify": 10,
+    }
+    DEFAULT_QUOTA_UNITS = 10
+    RATE_LIMIT_STATUS_CODES = {429}
+    SERVER_ERROR_STATUS_CODES = {500, 502, 503, 504}
+    RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+    _shared = None
+
+    def __init__(self, gmail_client_config):
+        self.config = gmail_client_config
+        self.rate = gmail_client_config["quota_units_per_second"]
+        self.capacity = gmail_client_config["quota_units_per_second"]
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.start_run()
+
+    @classmethod
+    def shared(cls, gmail_client_config):
+        if cls._shared is None or cls._shared.config != gmail_client_config:
+            cls._shared = cls(gmail_client_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {"quota_units": 0, "throttled_seconds": 0.0, "retries": 0}
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "throttled_seconds": round(self.counters["throttled_seconds"], 3)}
+
+    @staticmethod
+    def operation(method, path):
+        # "threads/<id>/modify" -> threads.modify, "messages/<id>" -> messages.get, "drafts" -> drafts.create
+        segments = path.split("?")[0].split("/")
+        if method == "GET":
+            return f"{segments[0]}.get" if len(segments) > 1 else f"{segments[0]}.list"
+        return f"{segments[0]}.create" if len(segments) == 1 else f"{segments[0]}.{segments[-1]}"
+
+    def acquire(self, units):
+        # Blocks the calling worker thread until the bucket holds enough quota for this call. A call that costs more
+        # than the whole bucket (messages.send under a quota below 100 units per second) waits for a full bucket
+        units = min(units, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= units:
+                    self.available -= units
+                    return
+                wait = (units - self.available) / self.rate
+            self.count("throttled_seconds", wait)
+            time.sleep(wait)
+
+    def should_retry(self, method, response):
+        if response.status_code in self.RATE_LIMIT_STATUS_CODES:
+            return True
+        if response.status_code in self.SERVER_ERROR_STATUS_CODES:
+            # A 502 or 504 on messages/send or drafts does not mean the call failed; resending could mail twice
+            return method == "GET"
+        return response.status_code == 403 and any(reason in response.text for reason in self.RATE_LIMIT_REASONS)
+
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.config["backoff_max_seconds"])
+        ceiling = min(self.config["backoff_max_seconds"], self.config["backoff_base_seconds"] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call(self, method, path, send):
+        units = self.QUOTA_UNITS.get(self.operation(method, path), self.DEFAULT_QUOTA_UNITS)
+        for attempt in range(self.config["max_retries"] + 1):
+            self.acquire(units)
+            self.count("quota_units", units)
+            final_attempt = attempt == self.config["max_retries"]
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Only reads are safe to resend after a dropped connection; a send or modify may have gone through
+                if method != "GET" or final_attempt:
+                    raise
+                print(f"Gmail {method} {path} failed ({e}), retrying.")
+                response = None
+            else:
+                if final_attempt or not self.should_retry(method, response):
+                    return response
+                print(f"Gmail {method} {path} returned {response.status_code}, retrying.")
+            self.count("retries", 1)
+            time.sleep(self.backoff_delay(attempt, response))
+
+
+class AsyncRuntime:
+    """
+    One event loop on a daemon thread, kept for the life of the process. Synchronous code submits coroutines to it
+    and waits for the result, so async clients opened on the loop keep their connections from one call, and one warm
+    invocation, to the next instead of being rebuilt on a fresh loop each time.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async-runtime", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None or not cls._shared.thread.is_alive():
+                cls._shared = cls()
+            return cls._shared
+
+    def submit(self, coroutine):
+        # Returns a concurrent.futures.Future; cancelling it cancels the task on the loop
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("AsyncRuntime.run called from the runtime's own loop; await the coroutine instead")
+        return self.submit(coroutine).result()
+
+    def run_all(self, coroutines):
+        # Run independent coroutines concurrently and return their results in order
+        async def gather():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather())
+
+
+class AsyncGmailClient:
+    """
+    Gmail REST client shared by the workflow steps. Requests run on worker threads under asyncio so independent
+    calls can be in flight together, capped at max_concurrency, and go out over the pooled HttpTransport sessions with
+    quota throttling and retries from GmailRateLimiter. Callers get the same requests.Response objects as before.
+    """
+    BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+    def __init__(self, headers, transport, rate_limiter, max_concurrency=8):
+        self.headers = headers
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._semaphore = None
+
+    def semaphore(self):
+        # asyncio primitives belong to one event loop; rebuilt only if the runtime ever has to start a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method, path, **kwargs):
+        url = f"{self.BASE_URL}/{path}"
+        async with self.semaphore():
+            return await asyncio.to_thread(
+                self.rate_limiter.call, method, path, lambda: self.transport.request(method, url, headers=self.headers, **kwargs)
+            )
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    def run_all(self, coroutines):
+        # Run independent requests concurrently on the shared runtime and return their responses in order
+        return AsyncRuntime.shared().run_all(coroutines)
+
+    def run(self, coroutine):
+        return self.run_all([coroutine])[0]
 
 
 class ApplyLabel:
@@ -179,13 +1217,17 @@ class ApplyLabel:
             "Authorization": f'Bearer {self.pd.inputs["gmail_custom_oauth"]["$auth"]["oauth_access_token"]}',
             "Content-Type": "application/json"
         }
+        gmail_client_config = self.pd.steps["workflow_config"]["gmail_client_config"]
+        http_transport = HttpTransport.shared(self.pd.steps["workflow_config"]["http_transport_config"])
+        rate_limiter = GmailRateLimiter.shared(gmail_client_config)
+        self.gmail_client = AsyncGmailClient(self.headers, http_transport, rate_limiter, gmail_client_config["max_concurrency"])
 
     def get_current_labels(self, thread_id):
-        url = f'https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}'
-        response = requests.get(url, headers=self.headers)
+        # Only label ids are read, so skip the message payloads
+        response = self.gmail_client.run(self.gmail_client.get(f"threads/{thread_id}", params={"format": "minimal"}))
         if response.status_code == 200:
             thread_data = response.json()
-            current_labels = [message['labelIds'] for message in thread_data['messages']]
+            current_labels = [message.get('labelIds', []) for message in thread_data['messages']]
             # Flatten the list of label IDs and remove duplicates
             return set([label for sublist in current_labels for label in sublist])
         else:
@@ -211,8 +1253,7 @@ class ApplyLabel:
         }
 
         # Make the API call to modify the labels
-        url = f'https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}/modify'
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.gmail_client.run(self.gmail_client.post(f"threads/{thread_id}/modify", json=payload))
         if response.status_code == 200:
             print(f"Labels successfully applied to thread {thread_id}")
         else:
@@ -220,68 +1261,252 @@ class ApplyLabel:
             raise Exception(f"Error applying labels: {response.text}")
 
 
+class CascadeRouter:
+    """One model call per router, in order; the handler stops calling as soon as a gate exits the workflow."""
+    def __init__(self, email_handler):
+        self.email_handler = email_handler
+        self.token_counter = email_handler.token_counter
+
+    def record(self, answer, name):
+        # Only model calls are spent tokens; reused answers are already in the ledger as saved
+        result, model_called = answer
+        if model_called:
+            self.token_counter.count_and_record(self.email_handler.input_data, result, name)
+        return result
+
+    def classification(self):
+        return self.record(self.email_handler.classify_email(), "classify_email")
+
+    def relevancy(self):
+        return self.record(self.email_handler.check_relevancy(), "check_relevancy")
+
+    def sensitivity(self, classification_result, relevancy_result):
+        return self.record(self.email_handler.check_sensitivity(classification_result, relevancy_result), "check_sensitivity")
+
+    def scenario_and_sentiment(self):
+        scenario_answer, sentiment_and_funnel_stage_answer = self.email_handler.handle_async_tasks()
+        return self.record(scenario_answer, "scenario"), self.record(sentiment_and_funnel_stage_answer, "sentiment_and_funnel_stage")
+
+    def finish(self):
+        # Nothing runs ahead of the handler, so nothing is wasted
+        pass
+
+    def stats(self):
+        return {}
+
+
+class FusedRouter:
+    """
+    Every router decision from one EmailRouting call, made on the first read. The handler's gates and early exits
+    are unchanged; each router step reads its own fields out of the single result.
+    """
+    def __init__(self, email_handler):
+        self.email_handler = email_handler
+        self.token_counter = email_handler.token_counter
+        self.routing_result = None
+
+    def route(self):
+        if self.routing_result is None:
+            self.routing_result, model_called = self.email_handler.route_fused()
+            if model_called:
+                self.token_counter.count_and_record(self.email_handler.input_data, self.routing_result, "fused_routing")
+
+    def pick(self, schema):
+        self.route()
+        return {field: self.routing_result.get(field) for field in schema.model_fields}
+
+    def classification(self):
+        return self.pick(EmailClassification)
+
+    def relevancy(self):
+        return self.pick(EmailRelevancy)
+
+    def sensitivity(self, classification_result, relevancy_result):
+        return self.pick(EmailSensitivity)
+
+    def scenario_and_sentiment(self):
+        return self.pick(EmailScenario), self.pick(EmailSentimentAndFunnelStage)
+
+    def finish(self):
+        # The single call is always read by the first router step
+        pass
+
+    def stats(self):
+        return {}
+
+
+class SpeculativeRouter:
+    """
+    Starts every router call at once on AsyncAIChat, on the shared AsyncRuntime, and hands the results to the
+    handler's gates in cascade order, so a relevant lead is routed in about the time of the slowest single call. When
+    a gate exits the workflow the calls still pending are cancelled; tokens spent on answers nobody reads are counted
+    as wasted.
+    """
+    # (router step, assembled prompt, schema, token ledger name)
+    ROUTERS = (
+        ("classification", "email_classification", EmailClassification, "classify_email"),
+        ("relevancy", "email_relevancy", EmailRelevancy, "check_relevancy"),
+        ("sensitivity", "email_sensitivity", EmailSensitivity, "check_sensitivity"),
+        ("scenario", "email_scenario", EmailScenario, "scenario"),
+        ("sentiment_and_funnel_stage", "email_sentiment_and_funnel_stage", EmailSentimentAndFunnelStage, "sentiment_and_funnel_stage"),
+    )
+
+    def __init__(self, email_handler):
+        self.email_handler = email_handler
+        self.token_counter = email_handler.token_counter
+        self.ledger_names = {name: ledger_name for name, _, _, ledger_name in self.ROUTERS}
+        self.counters = {"calls_started": 0, "calls_cancelled": 0, "results_unused": 0, "wasted_tokens": 0}
+        email_handler.ai_async.client = email_handler.http_transport.llm_async_client()
+        runtime = AsyncRuntime.shared()
+        self.futures = {name: runtime.submit(self.call(prompt_key, schema)) for name, prompt_key, schema, _ in self.ROUTERS}
+        self.counters["calls_started"] = len(self.futures)
+
+    async def call(self, prompt_key, schema):
+        # save_messages=False: the calls run side by side and must not see each other's answers
+        return await self.email_handler.ask_async(self.email_handler.assembled_prompts[prompt_key], schema, save_messages=False)
+
+    def read(self, name):
+        try:
+            result, model_called = self.futures.pop(name).result()
+        except BaseException:
+            # The handler stops here, so cancel the calls it will never read and record what they cost
+            self.finish()
+            raise
+        print(f"Speculative {name} result: {result}")
+        if model_called:
+            self.token_counter.count_and_record(self.email_handler.input_data, result, self.ledger_names[name])
+        return result
+
+    def classification(self):
+        return self.read("classification")
+
+    def relevancy(self):
+        return self.read("relevancy")
+
+    def sensitivity(self, classification_result, relevancy_result):
+        return self.read("sensitivity")
+
+    def scenario_and_sentiment(self):
+        return self.read("scenario"), self.read("sentiment_and_funnel_stage")
+
+    def finish(self):
+        # Cancel whatever the handler will not read and put the wasted tokens in the ledger
+        input_tokens = self.token_counter.count_tokens(self.email_handler.input_data)
+        wasted_tokens = 0
+        for name, future in self.futures.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Answered but never read: the whole call was wasted, unless the answer was reused at no cost
+                result, model_called = future.result()
+                self.counters["results_unused"] += 1
+                if model_called:
+                    wasted_tokens += input_tokens + self.token_counter.count_tokens(str(result))
+            elif future.cancel():
+                # The prompt was already sent, so its tokens are spent even though the answer is dropped
+                self.counters["calls_cancelled"] += 1
+                wasted_tokens += input_tokens
+        # Safe to call again: the futures are gone and only this call's waste goes into the ledger
+        self.futures = {}
+        self.counters["wasted_tokens"] += wasted_tokens
+        self.token_counter.record_wasted(wasted_tokens)
+
+    def stats(self):
+        return dict(self.counters)
+
+
+ROUTER_MODES = {"cascade": CascadeRouter, "fused": FusedRouter, "speculative": SpeculativeRouter}
+
+
+def export_stats(pd, email_handler, http_transport, rate_limiter, router=None, router_cache=None):
+    # The counters every exit of the handler exports; the router ones only once the routers have started
+    if router is not None:
+        router.finish()
+        pd.export("neighbor_index_stats", email_handler.finish_run())
+    pd.export("token_ledger", email_handler.token_counter.ledger())
+    if router is not None:
+        pd.export("router_stats", router.stats())
+        pd.export("router_cache_stats", router_cache.stats() if router_cache else {})
+    pd.export("http_transport_stats", http_transport.stats())
+    pd.export("gmail_rate_limiter_stats", rate_limiter.stats())
+
+
 def handler(pd: "pipedream"):
     # import config
     semantic_routers_config = pd.steps["workflow_config"]["semantic_routers_config"]
     email_labels = semantic_routers_config["email_labels"]
     print("semantic_router_config", semantic_routers_config)
     assembled_prompts = pd.steps["workflow_config"]["assembled_prompts"]
+    http_transport = HttpTransport.shared(pd.steps["workflow_config"]["http_transport_config"])
+    http_transport.start_run()
+    rate_limiter = GmailRateLimiter.shared(pd.steps["workflow_config"]["gmail_client_config"])
+    rate_limiter.start_run()
     #setup handler and token count
-    email_handler = EmailHandler(pd, semantic_routers_config, assembled_prompts)
-    total_tokens = 0 
+    router_cache = create_router_cache(semantic_routers_config["router_cache"])
+    neighbor_index = create_neighbor_index(semantic_routers_config["neighbor_index"])
+    email_handler = EmailHandler(pd, semantic_routers_config, assembled_prompts, http_transport, router_cache, neighbor_index)
+    token_counter = email_handler.token_counter
+
+    # Bulk and automated mail is labelled from its headers alone, before the thread summary or any router call
+    prefilter = HeaderPrefilter.shared(semantic_routers_config["prefilter"])
+    prefiltered = prefilter.check(pd.steps["parse_thread"]["headers"], pd.steps["parse_thread"]["sender"], pd.steps["parse_thread"]["mime_type"])
+    pd.export("prefilter_stats", prefilter.stats())
+    if prefiltered:
+        print(f"Header pre-filter matched {prefilter.stats()['matched_rules']}. Applying 'NOT_FROM_REAL_PERSON' label and exiting workflow...")
+        email_handler.apply_label("EmailClassification", "NOT_FROM_REAL_PERSON", pd.steps["trigger"]["event"]["threadId"])
+        export_stats(pd, email_handler, http_transport, rate_limiter)
+        return pd.flow.exit('Email is bulk or automated mail. Exiting workflow.')
+
+    # Summarize older messages (or reuse the stored summary) before the routers run
+    email_handler.apply_thread_summary(create_thread_summary_store(semantic_routers_config["thread_summary"]))
+    pd.export("thread_context", {
+        "summary": email_handler.thread_summary,
+        "thread_messages": ThreadMessage.dump_all(email_handler.thread_messages)
+    })
+    pd.export("thread_summary_stats", email_handler.thread_summary_stats)
 
-    # Perform the EmailClassification task and count tokens
+    # Created once input_data is final: the speculative router starts its calls straight away
+    router = ROUTER_MODES[semantic_routers_config["router_mode"]](email_handler)
+
+    # Perform the EmailClassification task (tokens go into the ledger)
     print("Starting Email Classification...")
-    classification_result = email_handler.classify_email()
+    classification_result = router.classification()
     pd.export("classification result:", classification_result)
-    classify_email_tokens = email_handler.token_counter.count_and_export_tokens(email_handler.input_data, classification_result, "classify_email_tokens")
-    total_tokens += classify_email_tokens
 
     # Dynamically determine the label for EmailClassification
     classification_label = "NOT_FROM_REAL_PERSON" if classification_result['requiresResponse'] == 0 else None
     if classification_label:
         print(f"Applying '{classification_label}' label and exiting workflow...")
         email_handler.apply_label("EmailClassification", classification_label, pd.steps["trigger"]["event"]["threadId"])
-        pd.export("total_tokens", total_tokens)
+        export_stats(pd, email_handler, http_transport, rate_limiter, router, router_cache)
         return pd.flow.exit('Email does not require a response. Exiting workflow.')
 
-    # Perform the EmailRelevancy task and count tokens
+    # Perform the EmailRelevancy task
     print("Starting Email Relevancy Check...")
-    relevancy_result = email_handler.check_relevancy()
+    relevancy_result = router.relevancy()
     pd.export("relevancy result:", relevancy_result)
-    relevancy_tokens = email_handler.token_counter.count_and_export_tokens(email_handler.input_data, relevancy_result, "check_relevancy_tokens")
-    total_tokens += relevancy_tokens
 
     # Dynamically determine the label for EmailRelevancy
     relevancy_label = "NON_PROSPECTING_RELATED" if relevancy_result['isRelevant'] == 0 else None
     if relevancy_label:
         print(f"Applying '{relevancy_label}' label and exiting workflow...")
         email_handler.apply_label("EmailRelevancy", relevancy_label, pd.steps["trigger"]["event"]["threadId"])
-        pd.export("total_tokens", total_tokens)
+        export_stats(pd, email_handler, http_transport, rate_limiter, router, router_cache)
         return pd.flow.exit('Email is not relevant. Exiting workflow.')
 
-    # Perform the EmailSensitivity task using the results of the previous steps and count tokens
+    # Perform the EmailSensitivity task using the results of the previous steps
     print("Starting Email Sensitivity Check...")
-    sensitivity_result = email_handler.check_sensitivity(classification_result, relevancy_result)
+    sensitivity_result = router.sensitivity(classification_result, relevancy_result)
     pd.export("sensitivity result:", sensitivity_result)
-    sensitivity_tokens = email_handler.token_counter.count_and_export_tokens(email_handler.input_data, sensitivity_result, "check_sensitivity_tokens")
-    total_tokens += sensitivity_tokens  # Accumulate total tokens
 
     # Conditional logic based on sensitivity result
     if sensitivity_result['isSensitive'] == 1:
         # If email is sensitive then export result, which will be used in sending to just send notification to relevant stakeholder rather than generate a reply
         print("Email is sensitive. Skipping further classification.")
-        pd.export("total_tokens", total_tokens)  # Export total tokens before exiting
+        export_stats(pd, email_handler, http_transport, rate_limiter, router, router_cache)
         return 
     else:
         # Proceed with asynchronous tasks for non-sensitive emails
         print("Starting Asynchronous Tasks for Scenario and Sentiment & Funnel Stage...")
-        scenario_result, sentiment_and_funnel_stage_result = email_handler.handle_async_tasks()
-
-        # Count tokens for scenario and sentiment/funnel stage classification
-        scenario_tokens = email_handler.token_counter.count_and_export_tokens(email_handler.input_data, scenario_result, "scenario_tokens")
-        sentiment_and_funnel_stage_tokens = email_handler.token_counter.count_and_export_tokens(email_handler.input_data, sentiment_and_funnel_stage_result, "sentiment_and_funnel_stage_tokens")
-        total_tokens += scenario_tokens + sentiment_and_funnel_stage_tokens  # Accumulate total tokens
+        scenario_result, sentiment_and_funnel_stage_result = router.scenario_and_sentiment()
 
         pd.export("Sentiment and Funnel Stage Result", sentiment_and_funnel_stage_result)
         pd.export("email_scenario_result", scenario_result)
@@ -289,15 +1514,15 @@ def handler(pd: "pipedream"):
     
     # Apply labels based on the scenario and sentiment/funnel stage results
     print("Applying labels based on Scenario and Sentiment & Funnel Stage results...")
+    labels_to_apply = []
     if scenario_result['inquiry_type']:
-        email_handler.apply_label("EmailScenario", scenario_result['inquiry_type'], pd.steps["trigger"]["event"]["threadId"])
+        labels_to_apply.append(("EmailScenario", scenario_result['inquiry_type']))
     if scenario_result['sender_category']:
-        email_handler.apply_label("EmailScenario", scenario_result['sender_category'], pd.steps["trigger"]["event"]["threadId"])
+        labels_to_apply.append(("EmailScenario", scenario_result['sender_category']))
     if sentiment_and_funnel_stage_result['label']:
-        email_handler.apply_label("EmailSentimentAndFunnelStage", sentiment_and_funnel_stage_result['label'], pd.steps["trigger"]["event"]["threadId"])
-
-    # Sum the total tokens used in each step
-    print(f"Total Tokens Used: {total_tokens}")
+        labels_to_apply.append(("EmailSentimentAndFunnelStage", sentiment_and_funnel_stage_result['label']))
+    email_handler.apply_labels(labels_to_apply, pd.steps["trigger"]["event"]["threadId"])
 
     # Export the results for use in the next step
-    pd.export("total_tokens", total_tokens)
+    export_stats(pd, email_handler, http_transport, rate_limiter, router, router_cache)
+    print(f"Total Tokens Used: {token_counter.ledger()['total_tokens']}")
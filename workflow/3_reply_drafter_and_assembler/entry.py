@@ -5,8 +5,13 @@ from email.headerregistry import Address
 from email.utils import make_msgid
 # packages for interacting with OpenAI API 
 from simpleaichat import AIChat
+import hashlib
+from collections import OrderedDict
 import tiktoken
 import markdown
+# packages for pooled HTTP connections
+import threading
+import httpx
 
 
 # Drafting setup prompt. Will produce high quality context-aware responses that are succinct and use links to case studies and other resources
@@ -61,6 +66,50 @@ Outline:
 """
 
 
+class ThreadMessage:
+    """
+    One message of the exported thread. Steps hand these to each other as compact positional lists (dump_all and
+    load_all) instead of pre-formatted strings, and the prompt text is only rendered where it is used.
+    """
+    __slots__ = ("message_id", "sender", "recipients", "subject", "date", "body")
+
+    def __init__(self, message_id, sender, recipients, subject, date, body):
+        self.message_id = message_id
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+        self.date = date
+        self.body = body
+
+    def with_body(self, body):
+        return ThreadMessage(self.message_id, self.sender, self.recipients, self.subject, self.date, body)
+
+    def header_lines(self):
+        return [f"From: {self.sender}", f"To: {self.recipients}", f"Subject: {self.subject}", f"Date: {self.date}"]
+
+    def source(self):
+        # How back-references name this message, from the sender and date its rendered header shows
+        return f"from {self.sender} on {self.date}"
+
+    def render(self):
+        return "\n".join(self.header_lines()) + f"\n\n{self.body}"
+
+    @staticmethod
+    def render_all(messages, summary=None):
+        # Prompt text for a list of messages, after the rolling summary of older messages when there is one
+        rendered = [f"Summary of the earlier messages in this thread:\n{summary}"] if summary else []
+        return rendered + [message.render() for message in messages]
+
+    @staticmethod
+    def dump_all(messages):
+        # One list per message in __slots__ order, so the step export carries no repeated keys
+        return [[getattr(message, field) for field in ThreadMessage.__slots__] for message in messages]
+
+    @staticmethod
+    def load_all(rows):
+        return [ThreadMessage(*row) for row in rows]
+
+
 class EmailAssembler:
     def __init__(self, response, original_email, drafting_config):
         self.response = response
@@ -72,12 +121,13 @@ class EmailAssembler:
         self.response = self.inject_links()  # Call inject_links here
         self.context_block = self.create_context_block()
 
-    def format_original_message(self, original_message):
-        # Join the list of strings into a single string
-        original_message = ' '.join(original_message)
-        lines = original_message.split('\n')
-        headers = lines[:4]
-        content = lines[4:]
+    def format_original_message(self, thread_messages):
+        # The first message's headers form the quoted header block; every later message is quoted headers and all
+        headers = thread_messages[0].header_lines() if thread_messages else []
+        content = []
+        for index, message in enumerate(thread_messages):
+            content.extend(message.header_lines() if index else [])
+            content.extend(message.body.split('\n'))
         formatted_headers = [f"> {line}  " for line in headers if line.strip() != '']
         formatted_content = [f"> {line}  " for line in content if line.strip() != '']
         return '\n'.join(formatted_headers + [''] + formatted_content)
@@ -104,25 +154,180 @@ class EmailAssembler:
         html_parts = [markdown.markdown(part) for part in parts]
         return '---'.join(html_parts)
 
+# Loaded once per process and shared by every TokenCounter
+TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+
+
 class TokenCounter:
-    def __init__(self, pd):
+    """
+    Per-run token ledger on the module-level encoder. Counts are memoized by content hash across runs, so a thread
+    read by several calls is tokenized once. Every counted call lands in the ledger, exported once as "token_ledger".
+    """
+    MAX_CACHED_COUNTS = 512
+    _counts = OrderedDict()
+    _counts_lock = threading.Lock()
+
+    def __init__(self, pd, http_transport=None):
         self.pd = pd
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.http_transport = http_transport
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.wasted_tokens = 0
+        self.saved_tokens = {}
 
     def count_tokens(self, text):
-        return len(self.encoding.encode(text))
-
-    def count_and_export_tokens(self, input_text, output_result, export_name):
-        # Count tokens in the input and output
-        input_token_count = self.count_tokens(input_text)
-        output_token_count = self.count_tokens(str(output_result))
-        total_tokens = input_token_count + output_token_count
-
-        # Export the total token count
-        self.pd.export(export_name, total_tokens)
-
-        # Return the total token count
-        return total_tokens
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self._counts_lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        count = len(TOKEN_ENCODING.encode(text))
+        with self._counts_lock:
+            self._counts[key] = count
+            if len(self._counts) > self.MAX_CACHED_COUNTS:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_and_record(self, input_text, output_result, name):
+        # Adds one model call to the ledger and returns its input + output tokens
+        input_tokens = self.count_tokens(input_text)
+        output_tokens = self.count_tokens(str(output_result))
+        with self.lock:
+            entry = self.calls.setdefault(name, {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0})
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["total_tokens"] += input_tokens + output_tokens
+        return input_tokens + output_tokens
+
+    def record_wasted(self, tokens):
+        # Tokens billed for answers nobody reads
+        with self.lock:
+            self.wasted_tokens += tokens
+
+    def record_saved(self, source, tokens):
+        # Tokens a call would have cost had its answer not been reused from source
+        with self.lock:
+            self.saved_tokens[source] = self.saved_tokens.get(source, 0) + tokens
+
+    def ledger(self):
+        with self.lock:
+            spent_tokens = sum(entry["total_tokens"] for entry in self.calls.values())
+            return {
+                "calls": {name: dict(entry) for name, entry in self.calls.items()},
+                "spent_tokens": spent_tokens,
+                "wasted_tokens": self.wasted_tokens,
+                "total_tokens": spent_tokens + self.wasted_tokens,
+                "saved_tokens": dict(self.saved_tokens),
+                # What the API reported, prompt-cache hits included
+                "provider_usage": self.http_transport.llm_usage() if self.http_transport else {},
+            }
+
+
+class CountingHTTPTransport(httpx.HTTPTransport):
+    # simpleaichat sends timeout=None with every request, so the configured timeouts are enforced here instead
+    def __init__(self, http_transport, timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.http_transport = http_transport
+        self.timeout = timeout
+
+    def handle_request(self, request):
+        opened = []
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(event_name)
+
+        request.extensions["timeout"] = self.timeout.as_dict()
+        request.extensions["trace"] = trace
+        response = super().handle_request(request)
+        self.http_transport.count(request.url.host, len(opened))
+        return response
+
+
+class HttpTransport:
+    # The OpenAI half of HttpTransport in workflow/2_semantic_routers/entry.py
+    _shared = None
+
+    def __init__(self, transport_config):
+        self.config = transport_config
+        self._llm_client = None
+        self.llm_calls = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, transport_config):
+        if cls._shared is None or cls._shared.config != transport_config:
+            cls._shared = cls(transport_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {}
+            self.llm_calls = []
+
+    def llm_timeout(self):
+        return httpx.Timeout(self.config["llm_read_timeout"], connect=self.config["connect_timeout"])
+
+    def llm_limits(self):
+        return httpx.Limits(max_connections=self.config["pool_size"], max_keepalive_connections=self.config["pool_size"])
+
+    def llm_client(self):
+        # One keep-alive client for every synchronous OpenAI call
+        with self.lock:
+            if self._llm_client is None:
+                self._llm_client = httpx.Client(
+                    transport=CountingHTTPTransport(self, self.llm_timeout(), limits=self.llm_limits()),
+                    event_hooks={"response": [self.on_llm_response]}
+                )
+            return self._llm_client
+
+    def count(self, host, connections_opened):
+        with self.lock:
+            counters = self.counters.setdefault(host, {"requests": 0, "connections_opened": 0})
+            counters["requests"] += 1
+            counters["connections_opened"] += connections_opened
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {**counters, "connections_reused": counters["requests"] - counters["connections_opened"]}
+                for host, counters in self.counters.items()
+            }
+
+    def record_llm_usage(self, response):
+        # Usage block of an OpenAI-compatible response. cached_tokens is the part of the prompt the provider served
+        # from its prefix cache; it stays 0 for models or providers without prompt caching
+        try:
+            usage = response.json().get("usage") or {}
+        except ValueError:
+            return
+        if not usage:
+            return
+        with self.lock:
+            self.llm_calls.append({
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                "completion_tokens": usage.get("completion_tokens", 0),
+                "seconds": round(response.elapsed.total_seconds(), 3),
+            })
+
+    def on_llm_response(self, response):
+        response.read()
+        self.record_llm_usage(response)
+
+    def llm_usage(self):
+        with self.lock:
+            calls = [dict(call) for call in self.llm_calls]
+        prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+        cached_tokens = sum(call["cached_tokens"] for call in calls)
+        return {
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": sum(call["completion_tokens"] for call in calls),
+            "cached_share": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+        }
 
 def handler(pd: "pipedream"):
     try:
@@ -138,49 +343,58 @@ def handler(pd: "pipedream"):
             print("Forwarding instruction set. Exiting handler.")
             return  # Exit the handler early
         else:
-            # Instantiate the TokenCounter
-            token_counter = TokenCounter(pd)
             # Extract original email details
             sender = pd.steps["parse_thread"]["sender"]
             recipient = pd.steps["parse_thread"]["recipient"]
             subject = pd.steps["parse_thread"]["subject"]
-            content = pd.steps["parse_thread"]["contents"]
+            content = ThreadMessage.load_all(pd.steps["parse_thread"]["thread_messages"])
 
-            print(f"Original email details - Sender: {sender}, Recipient: {recipient}, Subject: {subject}, Content: {content}")
+            print(f"Original email details - Sender: {sender}, Recipient: {recipient}, Subject: {subject}, Content: {ThreadMessage.render_all(content)}")
 
             # Extract scenario details
             inquiry_type = pd.steps["semantic_routers"]["email_scenario_result"]
 
             full_drafting_context = common_context + variable_context
             
-            # Determine system prompt based on inquiry type
+            # Static text only and sent first, so every draft repeats the same prefix for the provider's prompt cache
+            # (see benchmarks/bench_prompt_cache.py); everything about the email goes in the user message
             system_prompt = full_drafting_context + "ALWAYS GENERATE YOUR RESPONSE IN MARKDOWN. Please use markdown."
 
             # Generate response using simpleaichat
             token = f'{pd.inputs["openai"]["$auth"]["api_key"]}'
             authorization = f'Bearer {token}'
             headers = {"Authorization": authorization}
-            ai = AIChat(console=False, save_messages=False, model="gpt-4-0125-preview", headers=headers, api_key=token, temperature=0.0)
-            input_data = f"Subject: {subject}. Content: {content}. Inquiry Type: {inquiry_type}."
+            http_transport = HttpTransport.shared(pd.steps["workflow_config"]["http_transport_config"])
+            http_transport.start_run()
+            ai = AIChat(
+                console=False, save_messages=False, model="gpt-4-0125-preview", headers=headers, api_key=token,
+                api_url=http_transport.config["llm_api_url"], temperature=0.0
+            )
+            ai.client = http_transport.llm_client()
+            token_counter = TokenCounter(pd, http_transport)
+            # The drafter gets the same "summary + recent messages" context as the routers; the assembled email
+            # still quotes the original messages
+            thread_context = pd.steps["semantic_routers"]["thread_context"]
+            thread_context = ThreadMessage.render_all(ThreadMessage.load_all(thread_context["thread_messages"]), thread_context["summary"])
+            input_data = f"Subject: {subject}. Content: {thread_context}. Inquiry Type: {inquiry_type}."
             print("Input data for AIChat: ", input_data)
             # Generate response using simpleaichat
             output = ai(input_data, system=system_prompt)
             print("Output from AIChat: ", output)
 
-            # Count and export tokens for draft response
-            draft_response_tokens = token_counter.count_and_export_tokens(input_data, output, "draft_response_tokens")
+            # Count the draft response tokens into the run's ledger
+            token_counter.count_and_record(input_data, output, "draft_response")
 
             # Assemble the email using EmailAssembler Class
             assembler = EmailAssembler(output, {"sender": sender, "recipient": recipient, "subject": subject, "content": content}, pd.steps["workflow_config"]["drafting_config"])
             context_block = assembler.assemble_email()
             print("Context Block Email: ", context_block)
-            
-            total_tokens = draft_response_tokens
+
 
             # Export the results for visibility
             pd.export("Context Block Email: ", context_block)
-            pd.export("draft_response_tokens", draft_response_tokens)
-            pd.export("total tokens", total_tokens)
+            pd.export("token_ledger", token_counter.ledger())
+            pd.export("http_transport_stats", http_transport.stats())
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
@@ -1,7 +1,197 @@
 from email.message import EmailMessage
 import base64
+import random
+import threading
+import time
 import requests
 from email.parser import BytesParser
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+
+class HttpTransport:
+    # Copy of HttpTransport in workflow/1_parse_thread/entry.py
+    _shared = None
+
+    def __init__(self, transport_config):
+        self.config = transport_config
+        self.timeout = (transport_config["connect_timeout"], transport_config["read_timeout"])
+        self.sessions = {}
+        self.connections_seen = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, transport_config):
+        if cls._shared is None or cls._shared.config != transport_config:
+            cls._shared = cls(transport_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {}
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config["pool_size"])
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        session = self.session(host)
+        response = session.request(method, url, **kwargs)
+        pools = session.get_adapter(url).poolmanager.pools
+        with self.lock:
+            # urllib3 bumps num_connections only when a pool has to open a new socket
+            connections = sum(pools[key].num_connections for key in pools.keys())
+            opened = connections - self.connections_seen.get(host, 0)
+            self.connections_seen[host] = connections
+        self.count(host, opened)
+        return response
+
+    def count(self, host, connections_opened):
+        with self.lock:
+            counters = self.counters.setdefault(host, {"requests": 0, "connections_opened": 0})
+            counters["requests"] += 1
+            counters["connections_opened"] += connections_opened
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {**counters, "connections_reused": counters["requests"] - counters["connections_opened"]}
+                for host, counters in self.counters.items()
+            }
+
+
+class GmailRateLimiter:
+    # Copy of GmailRateLimiter in workflow/1_parse_thread/entry.py, with the quota units of this step's calls
+    QUOTA_UNITS = {
+        "drafts.create": 10,
+        "messages.get": 5,
+        "messages.send": 100,
+    }
+    DEFAULT_QUOTA_UNITS = 10
+    RATE_LIMIT_STATUS_CODES = {429}
+    SERVER_ERROR_STATUS_CODES = {500, 502, 503, 504}
+    RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+    _shared = None
+
+    def __init__(self, gmail_client_config):
+        self.config = gmail_client_config
+        self.rate = gmail_client_config["quota_units_per_second"]
+        self.capacity = gmail_client_config["quota_units_per_second"]
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.start_run()
+
+    @classmethod
+    def shared(cls, gmail_client_config):
+        if cls._shared is None or cls._shared.config != gmail_client_config:
+            cls._shared = cls(gmail_client_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {"quota_units": 0, "throttled_seconds": 0.0, "retries": 0}
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "throttled_seconds": round(self.counters["throttled_seconds"], 3)}
+
+    @staticmethod
+    def operation(method, path):
+        # "threads/<id>/modify" -> threads.modify, "messages/<id>" -> messages.get, "drafts" -> drafts.create
+        segments = path.split("?")[0].split("/")
+        if method == "GET":
+            return f"{segments[0]}.get" if len(segments) > 1 else f"{segments[0]}.list"
+        return f"{segments[0]}.create" if len(segments) == 1 else f"{segments[0]}.{segments[-1]}"
+
+    def acquire(self, units):
+        # Blocks the calling worker thread until the bucket holds enough quota for this call. A call that costs more
+        # than the whole bucket (messages.send under a quota below 100 units per second) waits for a full bucket
+        units = min(units, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= units:
+                    self.available -= units
+                    return
+                wait = (units - self.available) / self.rate
+            self.count("throttled_seconds", wait)
+            time.sleep(wait)
+
+    def should_retry(self, method, response):
+        if response.status_code in self.RATE_LIMIT_STATUS_CODES:
+            return True
+        if response.status_code in self.SERVER_ERROR_STATUS_CODES:
+            # A 502 or 504 on messages/send or drafts does not mean the call failed; resending could mail twice
+            return method == "GET"
+        return response.status_code == 403 and any(reason in response.text for reason in self.RATE_LIMIT_REASONS)
+
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.config["backoff_max_seconds"])
+        ceiling = min(self.config["backoff_max_seconds"], self.config["backoff_base_seconds"] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call(self, method, path, send):
+        units = self.QUOTA_UNITS.get(self.operation(method, path), self.DEFAULT_QUOTA_UNITS)
+        for attempt in range(self.config["max_retries"] + 1):
+            self.acquire(units)
+            self.count("quota_units", units)
+            final_attempt = attempt == self.config["max_retries"]
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Only reads are safe to resend after a dropped connection; a send or modify may have gone through
+                if method != "GET" or final_attempt:
+                    raise
+                print(f"Gmail {method} {path} failed ({e}), retrying.")
+                response = None
+            else:
+                if final_attempt or not self.should_retry(method, response):
+                    return response
+                print(f"Gmail {method} {path} returned {response.status_code}, retrying.")
+            self.count("retries", 1)
+            time.sleep(self.backoff_delay(attempt, response))
+
+
+class GmailClient:
+    """
+    Gmail REST client for this step, over the pooled HttpTransport sessions with quota throttling and retries from
+    GmailRateLimiter. Each call here needs the result of the one before it (the draft or reply needs the Message-ID
+    lookup), so calls run one at a time on the calling thread.
+    """
+    BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+    def __init__(self, headers, transport, rate_limiter):
+        self.headers = headers
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+
+    def request(self, method, path, **kwargs):
+        url = f"{self.BASE_URL}/{path}"
+        return self.rate_limiter.call(method, path, lambda: self.transport.request(method, url, headers=self.headers, **kwargs))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
 
 
 class EmailManager:
@@ -15,6 +205,10 @@ class EmailManager:
             "Authorization": f'Bearer {pd.inputs["gmail_custom_oauth"]["$auth"]["oauth_access_token"]}',
             "Content-Type": "application/json"
         }
+        gmail_client_config = pd.steps["workflow_config"]["gmail_client_config"]
+        self.http_transport = HttpTransport.shared(pd.steps["workflow_config"]["http_transport_config"])
+        self.rate_limiter = GmailRateLimiter.shared(gmail_client_config)
+        self.gmail_client = GmailClient(self.headers, self.http_transport, self.rate_limiter)
 
     def is_domain_whitelisted(self, email_address):
         if self.whitelisted_domains["enabled"]:
@@ -42,7 +236,6 @@ class EmailManager:
         raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
 
         # Create the draft with the correct headers for threading
-        url = 'https://gmail.googleapis.com/gmail/v1/users/me/drafts'
         payload = {
             "message": {
                 "raw": raw_message,
@@ -53,7 +246,7 @@ class EmailManager:
                 ]
             }
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.gmail_client.post("drafts", json=payload)
         print(f"create_draft_existing_thread() response: {response.json()}")
         return response
 
@@ -71,8 +264,7 @@ class EmailManager:
 
     def get_original_email(self, message_id):
         print("Retrieving original email...")
-        url = f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{message_id}?format=raw"
-        response = requests.get(url, headers=self.headers)
+        response = self.gmail_client.get(f"messages/{message_id}", params={"format": "raw"})
         print(f"get_original_email response: {response}")
         if response.status_code != 200:
             raise Exception(f"Error occurred while retrieving the email. Status code: {response.status_code}")
@@ -119,19 +311,18 @@ class EmailManager:
 
     def _send(self, raw_message, thread_id):
         print("Sending email...")
-        url = 'https://gmail.googleapis.com/gmail/v1/users/me/messages/send'
         payload = {"raw": raw_message, "threadId": thread_id}
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.gmail_client.post("messages/send", json=payload)
         if response.status_code != 200:
             raise Exception(f"Error occurred while sending the email. Status code: {response.status_code}")
         print(f"Email sent. Status code: {response.status_code}")
         self.pd.export("email_send_status_code", response.status_code)
 
 # Existing function to retrieve the IMAP message ID
-def get_imap_message_id(headers, latest_message_id):
+def get_imap_message_id(gmail_client, latest_message_id):
     print("Retrieving IMAP message ID...")
-    url = f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{latest_message_id}?format=metadata&metadataHeaders=message-id"
-    response = requests.get(url, headers=headers).json()
+    params = {"format": "metadata", "metadataHeaders": "message-id"}
+    response = gmail_client.get(f"messages/{latest_message_id}", params=params).json()
     print(f"get_imap_message_id() response: {response}")  # Log the response
     if "payload" not in response:
         raise Exception("Error: 'payload' key not found in the response")
@@ -145,7 +336,9 @@ def handler(pd: "pipedream"):
     print("Starting handler...")
     sending_manager_config = pd.steps["workflow_config"]["sending_manager_config"]
     email_manager = EmailManager(pd, sending_manager_config)
-    
+    email_manager.http_transport.start_run()
+    email_manager.rate_limiter.start_run()
+
     try:
         # Define a list of whitelisted domains. If the list is empty, all domains are allowed.
         whitelisted_domains = ["makebttr.com", "jdietle.me"]
@@ -178,15 +371,18 @@ def handler(pd: "pipedream"):
                 context_block = pd.steps["reply_drafter_and_assembler"]["Context Block Email: "]
                 if isinstance(context_block, list):
                     context_block = '\n'.join(context_block)
-                message_id = get_imap_message_id(email_manager.headers, pd.steps["parse_thread"]["message_id"])
+                message_id = get_imap_message_id(email_manager.gmail_client, pd.steps["parse_thread"]["message_id"])
                 email_manager.create_draft_existing_thread(most_recent_sender, subject, context_block, thread_id, message_id)
             else:
                 print("Sending email...")
                 context_block = pd.steps["reply_drafter_and_assembler"]["Context Block Email: "]
                 if isinstance(context_block, list):
                     context_block = '\n'.join(context_block)
-                message_id = get_imap_message_id(email_manager.headers, pd.steps["parse_thread"]["message_id"])
+                message_id = get_imap_message_id(email_manager.gmail_client, pd.steps["parse_thread"]["message_id"])
                 email_manager.send_email(most_recent_sender, subject, context_block, thread_id, message_id)
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         pd.export("email_status", f"Error: {str(e)}")
+    finally:
+        pd.export("http_transport_stats", email_manager.http_transport.stats())
+        pd.export("gmail_rate_limiter_stats", email_manager.rate_limiter.stats())
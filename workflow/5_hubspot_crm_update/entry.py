@@ -5,14 +5,89 @@
 from hubspot.crm.contacts import SimplePublicObjectInput, ApiException as ContactsApiException
 from hubspot.crm.deals import ApiException as DealsApiException, PublicObjectSearchRequest, SimplePublicObjectInputForCreate, FilterGroup, Filter
 from hubspot.crm.timeline import ApiException as TimelineApiException
+from hubspot.discovery.discovery_base import DiscoveryBase
 import hubspot
+# packages for pooled HTTP connections
+import ssl
+import threading
+import urllib3
+
+
+class TimeoutPoolManager(urllib3.PoolManager):
+    # The generated HubSpot clients send timeout=None unless a call passes _request_timeout, so fill in the configured one
+    def __init__(self, http_transport, timeout, **kwargs):
+        super().__init__(timeout=timeout, **kwargs)
+        self.http_transport = http_transport
+        self.default_timeout = timeout
+
+    def urlopen(self, method, url, redirect=True, **kw):
+        if kw.get("timeout") is None:
+            kw["timeout"] = self.default_timeout
+        response = super().urlopen(method, url, redirect=redirect, **kw)
+        self.http_transport.record(self.connection_from_url(url))
+        return response
+
+
+class HttpTransport:
+    # HttpTransport of workflow/1_parse_thread/entry.py over one urllib3 pool shared by every HubSpot API client
+    _shared = None
+
+    def __init__(self, transport_config):
+        self.config = transport_config
+        self.connections_seen = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.pool_manager = TimeoutPoolManager(
+            self,
+            urllib3.Timeout(connect=transport_config["connect_timeout"], read=transport_config["read_timeout"]),
+            maxsize=transport_config["pool_size"],
+            cert_reqs=ssl.CERT_REQUIRED
+        )
+
+    @classmethod
+    def shared(cls, transport_config):
+        if cls._shared is None or cls._shared.config != transport_config:
+            cls._shared = cls(transport_config)
+        return cls._shared
+
+    def start_run(self):
+        with self.lock:
+            self.counters = {}
+
+    def hubspot_api_factory(self, api_client_package, api_name, config):
+        # hubspot builds a new ApiClient, and with it a new connection pool, on every API access; point them all at ours
+        api = DiscoveryBase._default_api_factory(api_client_package, api_name, config)
+        api.api_client.rest_client.pool_manager = self.pool_manager
+        return api
+
+    def record(self, pool):
+        host = pool.host
+        with self.lock:
+            # urllib3 bumps num_connections only when the pool has to open a new socket
+            opened = pool.num_connections - self.connections_seen.get(host, 0)
+            self.connections_seen[host] = pool.num_connections
+        self.count(host, opened)
+
+    def count(self, host, connections_opened):
+        with self.lock:
+            counters = self.counters.setdefault(host, {"requests": 0, "connections_opened": 0})
+            counters["requests"] += 1
+            counters["connections_opened"] += connections_opened
+
+    def stats(self):
+        with self.lock:
+            return {
+                host: {**counters, "connections_reused": counters["requests"] - counters["connections_opened"]}
+                for host, counters in self.counters.items()
+            }
+
 
 class HubSpotManager:
-    def __init__(self, pd):
+    def __init__(self, pd, http_transport):
         self.pd = pd
         self.access_token = pd.inputs["hubspot_developer_app"]["$auth"]["oauth_access_token"]
         print(self.access_token)
-        self.client = hubspot.Client.create(access_token=self.access_token)
+        self.client = hubspot.Client.create(access_token=self.access_token, api_factory=http_transport.hubspot_api_factory)
 
     def get_contact_by_email(self, email):
         print(f"Attempting to get contact by email: {email}")
@@ -120,7 +195,9 @@ class HubSpotManager:
 
 def handler(pd: "pipedream"):
     print("Handler started")
-    hubspot_manager = HubSpotManager(pd)
+    http_transport = HttpTransport.shared(pd.steps["workflow_config"]["http_transport_config"])
+    http_transport.start_run()
+    hubspot_manager = HubSpotManager(pd, http_transport)
     email = pd.steps["parse_thread"]["most_recent_sender"]
     sentiment_and_funnel_stage_result = pd.steps["parallel_function_call_sentiment_analysis"]["Sentiment and Funnel Stage Result"]["label"]
     
@@ -167,3 +244,5 @@ def handler(pd: "pipedream"):
             print("No contact ID found, exiting handler")
     else:
         print(f"The sentiment and funnel stage result '{sentiment_and_funnel_stage_result}' does not match any deal stage.")
+
+    pd.export("http_transport_stats", http_transport.stats())
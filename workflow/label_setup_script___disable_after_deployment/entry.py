@@ -1,34 +1,96 @@
+import asyncio
 import requests
 import json
 
 
-def create_label(pd, label_name, parent_label_id=None):
+class AsyncGmailClient:
+    """
+    Gmail REST client shared by the workflow steps. Requests run on worker threads under asyncio so independent
+    calls can be in flight together, capped at max_concurrency, and go out over one requests session. Callers get the
+    same requests.Response objects as before.
+    """
+    BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+    def __init__(self, headers, transport, max_concurrency=8):
+        self.headers = headers
+        self.transport = transport
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._semaphore = None
+
+    def semaphore(self):
+        # asyncio primitives belong to one event loop, so rebuild the cap for each loop we run on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method, path, **kwargs):
+        url = f"{self.BASE_URL}/{path}"
+        async with self.semaphore():
+            return await asyncio.to_thread(self.transport.request, method, url, headers=self.headers, **kwargs)
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    def run_all(self, coroutines):
+        # Run independent requests concurrently and return their responses in order
+        async def gather():
+            return await asyncio.gather(*coroutines)
+        return asyncio.run(gather())
+
+    def run(self, coroutine):
+        return self.run_all([coroutine])[0]
+
+
+def create_gmail_client(pd):
     headers_gmail = {
         "Authorization": f'Bearer {pd.inputs["gmail_custom_oauth"]["$auth"]["oauth_access_token"]}',
         "Content-Type": "application/json"
     }
-    payload_create_label = {
-        "name": label_name,
-        "labelListVisibility": "labelShow",
-        "messageListVisibility": "show",
-        "parent": parent_label_id
-    }
-    url_gmail = 'https://gmail.googleapis.com/gmail/v1/users/me/labels'
-    create_response = requests.post(url_gmail, headers=headers_gmail, data=json.dumps(payload_create_label))
-    if create_response.status_code == 200:
-        label_info = create_response.json()
-        print(f'Created label with name "{label_name}" and ID "{label_info.get('id')}".')
-        return label_info
-    else:
-        print(f'An error occurred while creating the label "{label_name}".')
-        print(f'Status code: {create_response.status_code}')
-        print(f'Error message: {create_response.text}')
-        return None
-    
+    gmail_client_config = pd.steps["workflow_config"]["gmail_client_config"]
+    # A one-off script of a few dozen label creations needs neither the workflow's pooled HttpTransport nor its
+    # GmailRateLimiter; one session per client is enough
+    return AsyncGmailClient(headers_gmail, requests.Session(), gmail_client_config["max_concurrency"])
+
+def create_label(pd, label_name, parent_label_id=None):
+    return create_labels(pd, [(label_name, parent_label_id)])[0]
+
+def create_labels(pd, labels):
+    # labels: (label_name, parent_label_id) pairs. The labels are independent, so they are created concurrently.
+    gmail_client = create_gmail_client(pd)
+    requests_to_run = []
+    for label_name, parent_label_id in labels:
+        payload_create_label = {
+            "name": label_name,
+            "labelListVisibility": "labelShow",
+            "messageListVisibility": "show",
+            "parent": parent_label_id
+        }
+        requests_to_run.append(gmail_client.post("labels", data=json.dumps(payload_create_label)))
+    create_responses = gmail_client.run_all(requests_to_run)
+
+    created_labels = []
+    for (label_name, _), create_response in zip(labels, create_responses):
+        if create_response.status_code == 200:
+            label_info = create_response.json()
+            print(f'Created label with name "{label_name}" and ID "{label_info.get('id')}".')
+            created_labels.append(label_info)
+        else:
+            print(f'An error occurred while creating the label "{label_name}".')
+            print(f'Status code: {create_response.status_code}')
+            print(f'Error message: {create_response.text}')
+            created_labels.append(None)
+    return created_labels
+
 def create_parent_labels(pd, label_categories):
     parent_labels = {}
-    for category in label_categories:
-        parent_label_info = create_label(pd, category)
+    categories = list(label_categories)
+    for category, parent_label_info in zip(categories, create_labels(pd, [(category, None) for category in categories])):
         if parent_label_info:
             parent_labels[category] = parent_label_info['id']
         else:
@@ -38,14 +100,14 @@ def create_parent_labels(pd, label_categories):
 def create_and_organize_labels(pd, label_categories, parent_labels):
     organized_labels = {category: {} for category in label_categories}
 
-    for category, sub_labels in label_categories.items():
-        parent_label_id = parent_labels.get(category)
-        for sub_label_name in sub_labels:
-            label_info = create_label(pd, sub_label_name, parent_label_id)
-            if label_info:
-                organized_labels[category][sub_label_name] = label_info['id']
-            else:
-                print(f"Failed to create sub label '{sub_label_name}' under parent label '{category}'")
+    # Sub labels only depend on their parent, which already exists, so every sub label is created in one batch
+    sub_labels = [(category, sub_label_name) for category, names in label_categories.items() for sub_label_name in names]
+    label_infos = create_labels(pd, [(sub_label_name, parent_labels.get(category)) for category, sub_label_name in sub_labels])
+    for (category, sub_label_name), label_info in zip(sub_labels, label_infos):
+        if label_info:
+            organized_labels[category][sub_label_name] = label_info['id']
+        else:
+            print(f"Failed to create sub label '{sub_label_name}' under parent label '{category}'")
 
     return organized_labels
 